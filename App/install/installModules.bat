@@ -11,6 +11,7 @@ pip install psycopg2
 pip install sqlalchemy
 pip install asammdf
 pip install pyarrow
+pip install numba
 pip install can_decoder
 pip install canedge_browser
 pip install mdf_iter
@@ -0,0 +1,620 @@
+# Made by Ondrej Luks, 2023
+# ondrej.luks@doosan.com
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+from multiprocessing import shared_memory
+import json
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    # optional, compiles the per-sample loop of tolerance methods
+    from numba import njit
+except ImportError:
+    njit = None
+
+# pending aggregation states kept between runs
+AGG_STATE_PATH = os.path.join(os.path.dirname(__file__), "agg_state.json")
+
+# aggregation methods - (name, absolute band, relative band)
+AGG_METHODS = ("exact", "deadband", "swinging_door")
+EXACT = ("exact", 0.0, 0.0)
+
+# statistics of rollup tables, times of the first and last value let partial buckets merge in any order
+ROLLUP_COLUMNS = ["min", "max", "avg", "count", "first", "last", "first_time", "last_time"]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def time_stamps_ns(index: pd.DatetimeIndex) -> np.ndarray:
+    """Returns the given datetime index as an int64 array of nanoseconds (UTC)"""
+    return np.asarray(index.values, dtype="datetime64[ns]").view(np.int64)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def change_point_indices(values: np.ndarray, time_stamps: np.ndarray, max_skip_ns: int) -> np.ndarray:
+    """Returns sorted row positions to keep when aggregating one time-sorted signal.
+
+    Kept rows are the first and the last sample, both samples around every value change and
+    a heartbeat sample whenever the value stays the same for longer than max_skip_ns.
+    """
+    return chunk_change_points(values, time_stamps, max_skip_ns)[0]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def chunk_change_points(values: np.ndarray, time_stamps: np.ndarray, max_skip_ns: int,
+                        first_kept: bool = True, anchor_ns: int = None, final: bool = True) -> tuple:
+    """Same as change_point_indices for a signal delivered in consecutive chunks.
+
+    The first row of a continued chunk is the last row of the previous chunk, which was left undecided.
+    first_kept tells if that row is kept already and anchor_ns is the time of the last kept sample of its run.
+    Unless final is set, the last row is left undecided and excluded from the result. Returns the row
+    positions to keep and the state of the last row (first_kept and anchor_ns for the next chunk).
+    """
+    num_rows = len(values)
+    if num_rows == 0:
+        return np.empty(0, dtype=np.int64), first_kept, anchor_ns
+
+    keep = np.zeros(num_rows, dtype=bool)
+    keep[0] = first_kept
+
+    # value changes - keep the last sample of the old value and the first one of the new value
+    changes = np.flatnonzero(values[1:] != values[:-1]) + 1
+    keep[changes] = True
+    keep[changes - 1] = True
+
+    # runs of a constant value, each run starts either at the beginning or at a change
+    run_starts = np.concatenate(([0], changes))
+    run_ends = np.concatenate((changes, [num_rows]))
+
+    # heartbeats - walk all runs at once, one heartbeat per run in every iteration
+    previous = run_starts
+    anchors = time_stamps[previous]
+    if anchor_ns is not None:
+        # the first run continues from the previous chunk
+        anchors[0] = anchor_ns
+
+    while previous.size > 0:
+        following = np.searchsorted(time_stamps, anchors + max_skip_ns, side="right")
+        following = np.maximum(following, previous + 1)
+        in_run = following < run_ends
+        keep[following[in_run]] = True
+        previous = following[in_run]
+        anchors = time_stamps[previous]
+        run_ends = run_ends[in_run]
+
+    # state of the last row for the next chunk
+    last_kept = bool(keep[-1])
+    kept_in_last_run = np.flatnonzero(keep[run_starts[-1]:])
+    if kept_in_last_run.size > 0:
+        anchor_ns = int(time_stamps[run_starts[-1] + kept_in_last_run[-1]])
+
+    if final:
+        keep[-1] = True
+        return np.flatnonzero(keep), last_kept, anchor_ns
+
+    return np.flatnonzero(keep[:-1]), last_kept, anchor_ns
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def _next_tolerance_point(values: np.ndarray, time_stamps: np.ndarray, anchor: int, max_skip_ns: int,
+                          method: str, abs_band: float, rel_band: float) -> int:
+    """Returns the position of the next sample to keep after the anchor, None if it is not decided within the data.
+    Samples are scanned in growing windows, so a long run of tolerated samples costs only a few numpy calls."""
+    num_rows = len(values)
+    band = max(abs_band, rel_band * abs(values[anchor]))
+    anchor_ns = time_stamps[anchor]
+
+    # heartbeat - the first sample later than max_skip_ns after the anchor
+    limit = max(int(np.searchsorted(time_stamps, anchor_ns + max_skip_ns, side="right")), anchor + 1)
+
+    # swinging door slopes of all samples scanned so far
+    upper_slope = np.inf
+    lower_slope = -np.inf
+
+    start = anchor + 1
+    window = 32
+    while start < num_rows:
+        stop = min(start + window, num_rows)
+        diffs = values[start:stop] - values[anchor]
+
+        if method == "deadband":
+            outside = np.flatnonzero(np.abs(diffs) > band)
+            if outside.size > 0:
+                return min(start + int(outside[0]), limit)
+
+        else:
+            # the door closes when the highest lower slope exceeds the lowest upper slope
+            elapsed = np.maximum(time_stamps[start:stop] - anchor_ns, 1).astype(np.float64)
+            upper = np.fmin.accumulate(np.concatenate(([upper_slope], (diffs + band) / elapsed)))[1:]
+            lower = np.fmax.accumulate(np.concatenate(([lower_slope], (diffs - band) / elapsed)))[1:]
+            closed = np.flatnonzero(lower > upper)
+            if closed.size > 0:
+                # keep the last sample the door still covered
+                return min(start + int(closed[0]) - 1, limit)
+
+            upper_slope = upper[-1]
+            lower_slope = lower[-1]
+
+        if limit < stop:
+            return limit
+
+        start = stop
+        window = min(window * 2, 65536)
+
+    return None
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def _tolerance_loop(values: np.ndarray, time_stamps: np.ndarray, max_skip_ns: int, swinging_door: bool,
+                    abs_band: float, rel_band: float) -> tuple:
+    """Sample by sample version of repeated _next_tolerance_point calls from the first row, compiled by numba.
+    Returns positions of kept samples after the first row and the last kept position."""
+    num_rows = len(values)
+    kept = np.empty(num_rows, dtype=np.int64)
+    num_kept = 0
+    anchor = 0
+    heartbeat = 0
+
+    while True:
+        band = max(abs_band, rel_band * abs(values[anchor]))
+        anchor_ns = time_stamps[anchor]
+        while heartbeat < num_rows and time_stamps[heartbeat] <= anchor_ns + max_skip_ns:
+            heartbeat += 1
+        limit = max(heartbeat, anchor + 1)
+
+        upper_slope = np.inf
+        lower_slope = -np.inf
+        following = -1
+        for idx in range(anchor + 1, num_rows):
+            diff = values[idx] - values[anchor]
+
+            if not swinging_door:
+                if abs(diff) > band:
+                    following = min(idx, limit)
+                    break
+
+            else:
+                elapsed = float(max(time_stamps[idx] - anchor_ns, 1))
+                # NaN values never narrow the door
+                if (diff + band) / elapsed < upper_slope:
+                    upper_slope = (diff + band) / elapsed
+                if (diff - band) / elapsed > lower_slope:
+                    lower_slope = (diff - band) / elapsed
+                if lower_slope > upper_slope:
+                    following = min(idx - 1, limit)
+                    break
+
+            if limit <= idx:
+                following = limit
+                break
+
+        if following < 0:
+            break
+
+        kept[num_kept] = following
+        num_kept += 1
+        anchor = following
+
+    return kept[:num_kept], anchor
+
+
+_tolerance_kernel = None
+if njit is not None:
+    try:
+        _tolerance_kernel = njit(cache=True)(_tolerance_loop)
+    except RuntimeError:
+        # no writable cache folder, e.g. in the frozen build
+        _tolerance_kernel = njit(_tolerance_loop)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def tolerance_change_points(values: np.ndarray, time_stamps: np.ndarray, max_skip_ns: int, method: str,
+                            abs_band: float = 0.0, rel_band: float = 0.0, anchor_ns: int = None,
+                            anchor_value: float = None, final: bool = True) -> tuple:
+    """Same as chunk_change_points for numeric signals aggregated with a tolerance.
+
+    Deadband keeps a sample when it differs from the last kept one by more than the band. Swinging door keeps
+    the last sample of a stretch the line from the last kept sample can pass within the band. The band is
+    the larger of abs_band and rel_band times the last kept value. Heartbeats follow max_skip_ns as usual.
+    anchor_ns and anchor_value describe the last kept sample of the previous chunk, None for a new signal.
+    Unless final is set, rows after the last kept one are left undecided. Returns the row positions to keep,
+    the state for the next chunk (first_kept, anchor_ns and anchor_value) and the first undecided row.
+    """
+    num_rows = len(values)
+    if num_rows == 0:
+        return np.empty(0, dtype=np.int64), True, anchor_ns, anchor_value, 0
+
+    values = np.asarray(values, dtype=np.float64)
+    time_stamps = np.asarray(time_stamps, dtype=np.int64)
+    if anchor_ns is None:
+        # the first sample of the signal is always kept
+        kept = [0]
+        shift = 0
+    else:
+        # the last kept sample of the previous chunk leads the data
+        values = np.concatenate(([anchor_value], values))
+        time_stamps = np.concatenate(([anchor_ns], time_stamps))
+        kept = []
+        shift = 1
+
+    if _tolerance_kernel is not None:
+        following, anchor = _tolerance_kernel(values, time_stamps, int(max_skip_ns), method == "swinging_door",
+                                              float(abs_band), float(rel_band))
+        kept.extend(following.tolist())
+
+    else:
+        # without numba every kept sample costs a few numpy calls
+        anchor = 0
+        while True:
+            following = _next_tolerance_point(values, time_stamps, anchor, max_skip_ns, method, abs_band, rel_band)
+            if following is None:
+                break
+
+            kept.append(following)
+            anchor = following
+
+    if final and anchor < len(values) - 1:
+        kept.append(len(values) - 1)
+
+    kept = np.asarray(kept, dtype=np.int64) - shift
+    return kept, True, int(time_stamps[anchor]), float(values[anchor]), anchor + 1 - shift
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def aggregate_chunk(values: np.ndarray, time_stamps: np.ndarray, max_skip_ns: int, method: tuple = EXACT,
+                    first_kept: bool = True, anchor_ns: int = None, anchor_value: float = None, final: bool = True) -> tuple:
+    """Aggregates one chunk of a signal with the given method. Non-numeric signals are always aggregated exactly.
+    Returns the row positions to keep, the state for the next chunk (first_kept, anchor_ns and anchor_value)
+    and the first undecided row."""
+    if method[0] == "exact" or values.dtype.kind not in "iuf":
+        idx_array, first_kept, anchor_ns = chunk_change_points(values, time_stamps, max_skip_ns, first_kept, anchor_ns, final)
+        return idx_array, first_kept, anchor_ns, None, len(values) - 1
+
+    return tolerance_change_points(values, time_stamps, max_skip_ns, *method, anchor_ns, anchor_value, final)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def aggregate_shared(times_name: str, values_name: str, value_dtype: str, total: int, offset: int, length: int,
+                     max_skip_ns: int, method: tuple = EXACT, first_kept: bool = True, anchor_ns: int = None,
+                     anchor_value: float = None, final: bool = True) -> tuple:
+    """Worker entry point. Aggregates one signal stored in shared memory blocks created by SharedSignalBuffer.
+    Returns the result of aggregate_chunk."""
+    times_shm = shared_memory.SharedMemory(name=times_name)
+    values_shm = shared_memory.SharedMemory(name=values_name)
+    try:
+        times = np.ndarray((total,), dtype=np.int64, buffer=times_shm.buf)[offset:offset + length]
+        values = np.ndarray((total,), dtype=np.dtype(value_dtype), buffer=values_shm.buf)[offset:offset + length]
+        result = aggregate_chunk(values, times, max_skip_ns, method, first_kept, anchor_ns, anchor_value, final)
+        # drop the views before closing the blocks
+        del times, values
+
+    finally:
+        times_shm.close()
+        values_shm.close()
+
+    return result
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+class SharedSignalBuffer():
+    """Packs time stamps and values of numeric signal dataframes into shared memory blocks,
+    so worker processes can aggregate them without pickling the dataframes. Signals of every value
+    dtype get their own pair of blocks, so integers are never promoted to floats and compared inexactly.
+
+    Methods
+    -------
+    - shared (sig_idx)
+    - task (sig_idx)
+    - release ()
+    """
+
+    def __init__(self, signals: list) -> None:
+        # only numeric signals can be shared, the rest is aggregated in the calling process
+        self._shared_idx = [idx for idx, df in enumerate(signals) if df.shape[0] > 0 and isinstance(df.dtypes.iloc[0], np.dtype) and df.dtypes.iloc[0].kind in "iuf"]
+        self._offsets = {}
+        # value dtype -> (times block, values block, number of rows)
+        self._blocks = {}
+
+        totals = {}
+        for idx in self._shared_idx:
+            value_dtype = signals[idx].dtypes.iloc[0]
+            self._offsets[idx] = (value_dtype, totals.get(value_dtype, 0), signals[idx].shape[0])
+            totals[value_dtype] = totals.get(value_dtype, 0) + signals[idx].shape[0]
+
+        for value_dtype, total in totals.items():
+            self._blocks[value_dtype] = (shared_memory.SharedMemory(create=True, size=total * 8),
+                                         shared_memory.SharedMemory(create=True, size=total * value_dtype.itemsize), total)
+
+        for idx in self._shared_idx:
+            value_dtype, offset, length = self._offsets[idx]
+            times_shm, values_shm, total = self._blocks[value_dtype]
+            times = np.ndarray((total,), dtype=np.int64, buffer=times_shm.buf)
+            values = np.ndarray((total,), dtype=value_dtype, buffer=values_shm.buf)
+            times[offset:offset + length] = time_stamps_ns(signals[idx].index)
+            values[offset:offset + length] = signals[idx].iloc[:, 0].to_numpy()
+
+            del times, values
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def shared(self, sig_idx: int) -> bool:
+        """Returns True if the signal with given index is stored in the shared blocks"""
+        return sig_idx in self._offsets
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def task(self, sig_idx: int) -> tuple:
+        """Returns arguments of aggregate_shared (without max_skip_ns) for the signal with given index"""
+        value_dtype, offset, length = self._offsets[sig_idx]
+        times_shm, values_shm, total = self._blocks[value_dtype]
+        return (times_shm.name, values_shm.name, value_dtype.str, total, offset, length)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def release(self) -> None:
+        """Closes and removes the shared memory blocks"""
+        for times_shm, values_shm, total in self._blocks.values():
+            for shm in (times_shm, values_shm):
+                shm.close()
+                shm.unlink()
+
+        self._blocks = {}
+        return
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+class SignalAggregator():
+    """Aggregation state of one signal processed in consecutive time-ordered chunks. Undecided rows
+    at the end of every chunk stay pending until the next chunk shows if they are needed.
+
+    Methods
+    -------
+    - continues (df)
+    - extend (df)
+    - state ()
+    - update (df, result, final)
+    - flush ()
+    - to_dict ()
+    - from_dict (state)
+    """
+
+    def __init__(self, signal: str, method: tuple = EXACT) -> None:
+        self.signal = str(signal)
+        self.method = tuple(method)
+        self._pending = None
+        self._first_kept = True
+        self._anchor_ns = None
+        self._anchor_value = None
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def continues(self, df: pd.DataFrame) -> bool:
+        """Returns False if the next chunk starts before the pending rows, e.g. when files are not processed in time order"""
+        if df.shape[0] == 0:
+            return True
+
+        if self._pending is not None:
+            return df.index[0] >= self._pending.index[-1]
+
+        if self._anchor_ns is not None:
+            return time_stamps_ns(df.index[:1])[0] >= self._anchor_ns
+
+        return True
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def extend(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Returns the next chunk of the signal preceded by the pending rows"""
+        if self._pending is None:
+            return df
+
+        return pd.concat([self._pending, df])
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def state(self) -> tuple:
+        """Returns method, first_kept, anchor_ns and anchor_value arguments of aggregate_chunk for the extended chunk"""
+        return self.method, self._first_kept, self._anchor_ns, self._anchor_value
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def update(self, df: pd.DataFrame, result: tuple, final: bool) -> pd.DataFrame:
+        """Stores the state after aggregate_chunk of the extended chunk df. Returns the aggregated rows."""
+        idx_array, self._first_kept, self._anchor_ns, self._anchor_value, undecided = result
+        if final or df.shape[0] == 0:
+            self._reset()
+        elif undecided < df.shape[0]:
+            self._pending = df.iloc[undecided:]
+        else:
+            self._pending = None
+
+        return df.iloc[idx_array]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def flush(self) -> pd.DataFrame:
+        """Returns the last pending row as the last sample of the signal and resets the state. None if nothing is pending."""
+        pending = self._pending
+        self._reset()
+        if pending is None:
+            return None
+
+        return pending.iloc[-1:]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _reset(self) -> None:
+        self._pending = None
+        self._first_kept = True
+        self._anchor_ns = None
+        self._anchor_value = None
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def to_dict(self) -> dict:
+        """Returns the state as a JSON serializable dictionary, None if there is no state"""
+        if self._pending is None and self._anchor_ns is None:
+            return None
+
+        pending = self._pending if self._pending is not None else pd.DataFrame({self.signal: []})
+        return {"signal": self.signal,
+                "method": list(self.method),
+                "time_ns": time_stamps_ns(pending.index).tolist(),
+                "value": pending.iloc[:, 0].tolist(),
+                "first_kept": self._first_kept,
+                "anchor_ns": self._anchor_ns,
+                "anchor_value": self._anchor_value}
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    @staticmethod
+    def from_dict(state: dict):
+        """Creates an aggregator from a dictionary made by to_dict"""
+        aggregator = SignalAggregator(state["signal"], state["method"])
+        if len(state["time_ns"]) > 0:
+            index = pd.to_datetime(state["time_ns"], utc=True).rename("TimeStamp")
+            aggregator._pending = pd.DataFrame({state["signal"]: state["value"]}, index=index)
+        aggregator._first_kept = state["first_kept"]
+        aggregator._anchor_ns = state["anchor_ns"]
+        aggregator._anchor_value = state["anchor_value"]
+        return aggregator
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+def rollup(df: pd.DataFrame, resolution: str) -> pd.DataFrame:
+    """Returns min, max, avg, count, first and last value (with their times) of a numeric signal per time bucket
+    of given resolution. Buckets are indexed by their start time."""
+    values = df.iloc[:, 0].astype(np.float64)
+    buckets = df.index.floor(resolution)
+    stats = values.groupby(buckets).agg(["min", "max", "mean", "count", "first", "last"])
+
+    # times of the first and last value which is not NaN
+    times = pd.Series(df.index, index=df.index).where(values.notna())
+    stats["first_time"] = times.groupby(buckets).first()
+    stats["last_time"] = times.groupby(buckets).last()
+
+    stats.columns = ROLLUP_COLUMNS
+    stats.index.name = df.index.name
+    return stats
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def merge_rollups(earlier: pd.DataFrame, later: pd.DataFrame) -> pd.DataFrame:
+    """Merges statistics of the same bucket computed from two consecutive parts of the signal (one row each)"""
+    a = earlier.iloc[0]
+    b = later.iloc[0]
+    count = a["count"] + b["count"]
+    total = (a["avg"] * a["count"] if a["count"] > 0 else 0.0) + (b["avg"] * b["count"] if b["count"] > 0 else 0.0)
+
+    merged = later.copy()
+    merged["min"] = np.fmin(a["min"], b["min"])
+    merged["max"] = np.fmax(a["max"], b["max"])
+    merged["avg"] = total / count if count > 0 else np.nan
+    merged["count"] = count
+    merged["first"] = a["first"] if not np.isnan(a["first"]) else b["first"]
+    merged["last"] = b["last"] if not np.isnan(b["last"]) else a["last"]
+    merged["first_time"] = a["first_time"] if not pd.isna(a["first_time"]) else b["first_time"]
+    merged["last_time"] = b["last_time"] if not pd.isna(b["last_time"]) else a["last_time"]
+    return merged
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+class SignalRollup():
+    """Rollup of one signal processed in consecutive time-ordered chunks. The last bucket of every chunk
+    stays open until a later bucket starts.
+
+    Methods
+    -------
+    - update (df)
+    - flush ()
+    """
+
+    def __init__(self, resolution: str) -> None:
+        self.resolution = resolution
+        self._open = None
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def update(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Adds the next chunk of the signal. Returns statistics of the buckets completed by it."""
+        stats = rollup(df, self.resolution)
+        if stats.shape[0] == 0:
+            return stats
+
+        completed = []
+        if self._open is not None:
+            if stats.index[0] == self._open.index[0]:
+                # the open bucket continues
+                stats = pd.concat([merge_rollups(self._open, stats.iloc[:1]), stats.iloc[1:]])
+            else:
+                completed.append(self._open)
+
+        completed.append(stats.iloc[:-1])
+        self._open = stats.iloc[-1:]
+        return pd.concat(completed).astype({"count": np.int64})
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def flush(self) -> pd.DataFrame:
+        """Returns statistics of the open bucket and closes it. None if no bucket is open."""
+        stats = self._open
+        self._open = None
+        if stats is None:
+            return None
+
+        return stats.astype({"count": np.int64})
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+def save_aggregators(aggregators: dict, path: str) -> None:
+    """Stores pending states of aggregators keyed by (device, signal) into a JSON file"""
+    states = [dict(device=device, **aggregator.to_dict()) for (device, signal), aggregator in aggregators.items() if aggregator.to_dict() is not None]
+
+    # write into a temporary file first, so a crash never leaves a half-written state
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(states, file)
+    os.replace(temp_path, path)
+    return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def load_aggregators(path: str) -> dict:
+    """Loads aggregators keyed by (device, signal) stored by save_aggregators, empty dictionary if there is no state"""
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, "r") as file:
+        states = json.load(file)
+
+    return {(state["device"], state["signal"]): SignalAggregator.from_dict(state) for state in states}
@@ -9,6 +9,7 @@ from .communication import PipeCommunication
 from .utils import Utils
 from .conversion import Conversion
 from .db_handle import DatabaseHandle
+from .decoding import purge_decoded_cache
 import threading
 
 # ================================================================================================================================
@@ -88,6 +89,10 @@ class BackendHandle():
                         else:
                             self._comm.send_error("WARNING", "Blank download requested!", False)
 
+                    case "PURGE-CACHE":
+                        # delete all decoded files of the cache
+                        self._purge_cache()
+
                     case "END":
                         self._thread_cleanup()
                         break
@@ -152,9 +157,7 @@ class BackendHandle():
 # --------------------------------------------------------------------------------------------------------------------------------
 
     def _fetch_signals(self) -> None:
-        self._db.connect()
         tbl_names = self._db.get_table_names()
-        self._db.finish()
 
         if not tbl_names == None:
             if len(tbl_names) == 0:
@@ -187,3 +190,16 @@ class BackendHandle():
         # begin signal download
         self._threads.append(self._utils.spawn_working_thread(fc=self._db.save_data, args=(sigs, from_str, to_str, file_name, file_type)))
         return
+
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _purge_cache(self) -> None:
+        try:
+            deleted = purge_decoded_cache()
+            self._comm.send_to_print(f"Decoded file cache purged, {round(deleted / (1024 * 1024), 1)} MB deleted.")
+
+        except Exception as e:
+            self._comm.send_error("WARNING", f"Problem with purging the decoded file cache:\n{e}", "F")
+
+        return
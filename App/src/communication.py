@@ -2,6 +2,8 @@
 # ondrej.luks@doosan.com
 
 
+import threading
+
 # ================================================================================================================================
 # ================================================================================================================================
 
@@ -10,29 +12,38 @@ class PipeCommunication():
     def __init__(self, conn, event):
         self._pipe = conn
         self._stop_event = event
+        # the pipe connection is not thread-safe, pipeline stages send at the same time
+        self._send_lock = threading.Lock()
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _send(self, message: str) -> None:
+        with self._send_lock:
+            self._pipe.send(message)
+        return
 
 # --------------------------------------------------------------------------------------------------------------------------------
 
     def send_to_print(self, message='', end='\n') -> None:
         if self._stop_event == None:
-            self._pipe.send(f"PRINT#{message}{end}")
+            self._send(f"PRINT#{message}{end}")
             return
         
         if not self._stop_event.is_set():
-            self._pipe.send(f"PRINT#{message}{end}")
+            self._send(f"PRINT#{message}{end}")
 
         return
 
 # --------------------------------------------------------------------------------------------------------------------------------  
 
     def send_command(self, command) -> None:
-        self._pipe.send(command)
+        self._send(command)
         return
     
 # --------------------------------------------------------------------------------------------------------------------------------  
 
     def send_error(self, type: str, message: str, terminate: str) -> None:
-        self._pipe.send(f"POP-ERR#{type}#{message}#{terminate}")
+        self._send(f"POP-ERR#{type}#{message}#{terminate}")
         return
     
 # --------------------------------------------------------------------------------------------------------------------------------
@@ -5,21 +5,27 @@
 # ================================================================================================================================
 # ================================================================================================================================
 
-from datetime import timedelta
-from threading import Lock
-
-from .mfd import MultiFrameDecoder
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from collections import deque
+from fnmatch import fnmatchcase
+
+from .decoding import decode_mf4_chunks, load_dbc, merge_signal_dbs, filter_signal_dbs, init_decode_worker, decode_mf4_worker, DBC_CACHE_PATH
+from .decoding import load_message_names, signal_messages
+from .decoding import decode_mf4_cached, dbc_set_key, DECODED_CACHE_PATH
+from .aggregation import aggregate_chunk, time_stamps_ns, aggregate_shared, SharedSignalBuffer, SignalAggregator, AGG_METHODS
+from .aggregation import SignalRollup
+from .aggregation import save_aggregators, load_aggregators, AGG_STATE_PATH
 from .utils import Utils
-from .proc_data import ProcessData
 from .db_handle import DatabaseHandle
+from .parquet_sink import ParquetSink
+from .sink import DataSink
 from .communication import PipeCommunication
 
-from pathlib import Path
 import pandas as pd
+import numpy as np
 import os
+import queue
 import threading
-import can_decoder
-import canedge_browser
 
 # ================================================================================================================================
 # ================================================================================================================================
@@ -36,30 +42,154 @@ class Conversion():
         self._comm = communication
         self._stop_event = stop_ev
         self._db = database
+        self._sink = database
         self._threads = thrs
         self._num_of_files = 0
         self._num_of_done_files = 0
+        self._num_of_failed_files = 0
+        self._failed_files = set()
+        self._held_files = []
+        self._file_devices = {}
+        self._aggregators = {}
+        self._agg_methods = []
+        self._rollups = {}
+        self._rollup_resolutions = []
         self._num_of_signals = 0
         self._num_of_agged_signals = 0
+        self._agg_pool = None
+        self._file_progress = []
+        self._progress_lock = threading.Lock()
+        self._abort_event = threading.Event()
 
         self._config = config
         self._dbc_list = None
+        self._decoded_cache = ("", "", 0)
         
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _dbc_paths(self) -> list:
+        """Returns paths to all DBC files in the DBC folder"""
+        dir = os.listdir(self._config["settings"]["dbc_path"])
+        if len(dir) == 0:
+            raise OSError
+
+        return [os.path.join(self._config["settings"]["dbc_path"], dbc_file) for dbc_file in dir if dbc_file.endswith(".dbc")]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _dbc_cache_path(self) -> str:
+        """Returns folder of the parsed DBC cache, empty string if the cache is disabled"""
+        if self._config["settings"].get("dbc_cache", "true") != "true":
+            return ""
+
+        return DBC_CACHE_PATH
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _load_decoded_cache(self) -> tuple:
+        """Returns (folder, DBC set key, size limit in bytes) of the decoded file cache, empty folder if the cache is disabled"""
+        settings = self._config["settings"]
+        if settings.get("decoded_cache", "false") != "true":
+            return ("", "", 0)
+
+        try:
+            max_bytes = int(float(settings.get("decoded_cache_mb", "2048")) * 1024 * 1024)
+            return (DECODED_CACHE_PATH, dbc_set_key(self._dbc_paths(), self._signal_patterns()), max_bytes)
+
+        except Exception as e:
+            self._comm.send_error("WARNING", f"Decoded file cache disabled:\n{e}", "F")
+            return ("", "", 0)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _signal_patterns(self) -> list:
+        """Returns signal names and glob patterns of the signal allow-list, empty list means all signals"""
+        patterns = self._config["settings"].get("signals", "").split(",")
+        return [pattern.strip() for pattern in patterns if pattern.strip() != ""]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _load_agg_methods(self) -> bool:
+        """Reads aggregation methods from config. Per-signal tolerances are stored first, the default method last."""
+        settings = self._config["settings"]
+        tolerances = list(settings.get("agg_tolerances", {}).items())
+        tolerances.append(("*", {"method": settings.get("agg_method", "exact"),
+                                 "abs": settings.get("agg_deadband_abs", "0"),
+                                 "rel": settings.get("agg_deadband_rel", "0")}))
+        self._agg_methods = []
+        try:
+            for pattern, tolerance in tolerances:
+                method = (tolerance.get("method", "exact"), float(tolerance.get("abs", "0")), float(tolerance.get("rel", "0")))
+                if method[0] not in AGG_METHODS:
+                    raise ValueError(f"Unknown aggregation method '{method[0]}' for '{pattern}', use one of: {', '.join(AGG_METHODS)}")
+                self._agg_methods.append((pattern, method))
+
+        except Exception as e:
+            self._comm.send_error("ERROR", f"Wrong aggregation settings in config:\n{e}", "T")
+            return False
+
+        return True
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _load_rollup_resolutions(self) -> bool:
+        """Reads bucket sizes of rollup tables from config"""
+        resolutions = self._config["settings"].get("rollups", "").split(",")
+        self._rollup_resolutions = [resolution.strip() for resolution in resolutions if resolution.strip() != ""]
+        try:
+            for resolution in self._rollup_resolutions:
+                # buckets need a fixed length, months or years can't be used
+                if not isinstance(pd.tseries.frequencies.to_offset(resolution), pd.offsets.Tick):
+                    raise ValueError(f"Rollup resolution '{resolution}' is not a fixed time span")
+
+        except Exception as e:
+            self._comm.send_error("ERROR", f"Wrong rollup settings in config:\n{e}", "T")
+            return False
+
+        return True
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _agg_method(self, signal_name: str) -> tuple:
+        """Returns the aggregation method of the signal given by the first matching pattern"""
+        for pattern, method in self._agg_methods:
+            if fnmatchcase(signal_name, pattern):
+                return method
+
+        return self._agg_methods[-1][1]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _load_signal_messages(self) -> bool:
+        """Passes the message of every signal to the database, message tables are named after DBC messages"""
+        if self._config["database"].get("layout", "signal_tables") != "message_tables":
+            return True
+
+        try:
+            message_names = {}
+            for dbc_path in self._dbc_paths():
+                for frame_id, name in load_message_names(dbc_path).items():
+                    message_names.setdefault(frame_id, name)
+
+            self._sink.set_signal_messages(signal_messages(self._dbc_list, message_names))
+
+        except Exception as e:
+            self._comm.send_error("ERROR", f"Can't read DBC messages:\n{e}", "T")
+            return False
+
+        return True
+
 # --------------------------------------------------------------------------------------------------------------------------------
 
     def create_dbc_list(self) -> list:
-        """""Creates a list of loaded DBC files via can_decoder"""""
+        """""Creates a list of loaded DBC files via can_decoder, merged into one database per protocol
+        and pruned to signals of the signal allow-list"""""
 
         db_list = []
         try:
-            dir = os.listdir(self._config["settings"]["dbc_path"])
-            if len(dir) == 0:
-                raise OSError
-
-            for dbc_file in dir:
-                if dbc_file.endswith(".dbc"):
-                    db = can_decoder.load_dbc(os.path.join(self._config["settings"]["dbc_path"], dbc_file))
-                    db_list.append(db)
+            for dbc_path in self._dbc_paths():
+                db = load_dbc(dbc_path, self._dbc_cache_path())
+                db_list.append(db)
 
         except OSError:
             self._comm.send_error("ERROR", "Can't load DBC files. Check for file existance.", "T")
@@ -67,6 +197,10 @@ class Conversion():
         except Exception as e:
             self._comm.send_error("ERROR", f"Problem with DBC files loading:\n{e}", "T")
 
+        db_list = filter_signal_dbs(merge_signal_dbs(db_list), self._signal_patterns())
+        if len(self._signal_patterns()) > 0 and len(db_list) == 0:
+            self._comm.send_error("WARNING", "No signal in DBC files matches the signal allow-list.", "F")
+
         return db_list
 
 # --------------------------------------------------------------------------------------------------------------------------------
@@ -77,157 +211,401 @@ class Conversion():
 
 # --------------------------------------------------------------------------------------------------------------------------------
 
-    def _setup_fs(self) -> canedge_browser.LocalFileSystem:
-        """Sets up a filesystem required for signal extraxtion from raw MF4"""
-        base_path = Path(__file__).parent
-        return canedge_browser.LocalFileSystem(base_path=base_path)
+    def _create_sink(self) -> DataSink:
+        """Returns the storage of converted signals selected in the settings - the database or a local parquet dataset"""
+        sink = self._config["settings"].get("sink", "database")
+        if sink == "parquet":
+            if self._config["settings"].get("parquet_path", "").strip() == "":
+                self._comm.send_error("ERROR", "Parquet sink is selected but parquet_path is not set in the settings!", "T")
+                return None
+
+            return ParquetSink(self._config, self._comm, self._stop_event)
+
+        if sink != "database":
+            self._comm.send_error("ERROR", f"Unknown sink: {sink}", "T")
+            return None
+
+        return self._db
 
 # --------------------------------------------------------------------------------------------------------------------------------
 
-    def _convert_mf4(self, mf4_file: os.path) -> list:
-        """Converts and decodes MF4 files to a dataframe using DBC files."""
-        try:
-            fs = self._setup_fs()
-            proc = ProcessData(fs, self._dbc_list)
+    def _convert_mf4(self, mf4_file: os.path, file_idx: int) -> list:
+        """Converts and decodes MF4 file to signal dataframes using DBC files. Returns None if the conversion was stopped."""
+        decoded = decode_mf4_cached(mf4_file, self._dbc_list, *self._decoded_cache, self._stop_event)
 
-            # thread end check
-            if self._stop_event.is_set():
-                print("Conversion aborted.")
-                return None
+        # thread end check
+        if decoded is None or self._stop_event.is_set():
+            print("Conversion aborted.")
+            return None
 
-            # get raw dataframe from mf4 file
-            df_raw, device_id = proc.get_raw_data(mf4_file)
+        return self._extract_signals(mf4_file, decoded, file_idx)
 
-            # thread end check
-            if self._stop_event.is_set():
-                print("Conversion aborted.")
-                return None
+# --------------------------------------------------------------------------------------------------------------------------------
 
-            # replace transport protocol with single frames
-            tp = MultiFrameDecoder("j1939")
-            df_raw = tp.combine_tp_frames(df_raw)
+    def _extract_signals(self, mf4_file: os.path, decoded: tuple, file_idx: int, time_info: bool = True) -> list:
+        """Writes time information of decoded MF4 file if required and splits it into signal dataframes"""
+        df_phys, skipped_frames, skipped_bytes, device_id = decoded
+        self._file_devices[file_idx] = device_id
+        if skipped_frames > 0:
+            self._comm.send_to_print(f"   - skipped {skipped_frames} undecodable frames ({skipped_bytes} bytes)")
 
-            # thread end check
-            if self._stop_event.is_set():
-                print("Conversion aborted.")
-                return None
+        if time_info and self._config["settings"]["write_time_info"] == "true":
+            self._comm.send_to_print("   - writing time information into MF4-info.csv...")
+            # check if df is not empty
+            if df_phys.shape[0] > 0:
+                self._utils.write_time_info(mf4_file, df_phys.index[0], df_phys.index[-1])
 
-            # extract can messages
-            df_phys = proc.extract_phys(df_raw)
+        self._comm.send_to_print("   - extracting individual signals...")
+        return self._split_df_by_cols(df_phys, file_idx)
 
-            # thread end check
-            if self._stop_event.is_set():
-                print("Conversion aborted.")
-                return None
+# --------------------------------------------------------------------------------------------------------------------------------
 
-            # set correct index values
-            df_phys.index = pd.to_datetime(df_phys.index)
-            df_phys.index = df_phys.index.round('1us')
+    def _conversion_failed(self, mf4_file: os.path, file_idx: int, e: Exception) -> None:
+        """Reports a file that could not be converted. The file is skipped and the rest of the files continue."""
+        self._comm.send_error("WARNING", f"Problem in MF4 conversion, skipping file {mf4_file}:\n{e}", "F")
+        self._num_of_failed_files += 1
+        self._failed_files.add(file_idx)
+        self._report_progress(file_idx, 1)
+        return
 
-            # thread end check
-            if self._stop_event.is_set():
-                print("Conversion aborted.")
-                return None
+# --------------------------------------------------------------------------------------------------------------------------------
 
-            # write time info if required
-            if self._config["settings"]["write_time_info"] == "true":
-                self._comm.send_to_print("   - writing time information into MF4-info.csv...")
-                # check if df is not empty
-                if df_phys.shape[0] > 0:
-                    self._utils.write_time_info(mf4_file, df_phys.index[0], df_phys.index[-1])
-        
-        except Exception as e:
-            self._comm.send_error("ERROR", f"Problem in MF4 conversion:\n{e}", "T")
-            return []
+    def _streamed_files(self, mf4_file_list: list, chunk_rows: int):
+        """Generator of (file index, file, signals, last chunk) of MF4 files converted in chunks of chunk_rows frames,
+        so decoded signals go through aggregation and upload in bounded pieces (raw frames see read_raw_chunks).
+        Yields signals None on stop."""
+        for file_idx, file in enumerate(mf4_file_list):
+            # clear the output textbox
+            self._comm.send_command("CLS")
+            self._comm.send_to_print(f" - Converting in chunks: {file}")
+            first_time, last_time = None, None
+            previous = None
+            try:
+                for decoded in decode_mf4_chunks(file, self._dbc_list, chunk_rows, self._stop_event):
+                    if decoded[0].shape[0] > 0:
+                        first_time = decoded[0].index[0] if first_time is None else first_time
+                        last_time = decoded[0].index[-1]
+
+                    # a chunk is sent once the next one is read, so the last one can be marked
+                    if previous is not None:
+                        yield file_idx, file, self._extract_signals(file, previous, file_idx, False), False
+                    previous = decoded
 
-        self._comm.send_to_print("   - extracting individual signals...")
-        return self._split_df_by_cols(df_phys)
+                # thread end check
+                if self._stop_event.is_set():
+                    print("Conversion aborted.")
+                    yield file_idx, file, None, True
+                    return
+
+                if self._config["settings"]["write_time_info"] == "true" and first_time is not None:
+                    self._comm.send_to_print("   - writing time information into MF4-info.csv...")
+                    self._utils.write_time_info(file, first_time, last_time)
+
+                converted_signals = [] if previous is None else self._extract_signals(file, previous, file_idx, False)
+
+            except Exception as e:
+                self._conversion_failed(file, file_idx, e)
+                # chunks sent before the failure are kept, the file ends here
+                converted_signals = []
+
+            yield file_idx, file, converted_signals, True
+
+        return
 
 # --------------------------------------------------------------------------------------------------------------------------------
 
-    def _aggregate(self, df, lock: threading.Lock, dfs: list) -> None:
-        """Aggregates input signal dataframe by removing redundant values"""
+    def _decoded_files(self, mf4_file_list: list):
+        """Generator of (file index, file, signals, last chunk) of converted MF4 files in the original order. Files are decoded
+        by a pool of worker processes, or in this thread if only one worker is configured. Yields signals None on stop."""
+        chunk_rows = int(self._config["settings"].get("stream_chunk_rows", "0"))
+        if chunk_rows > 0:
+            yield from self._streamed_files(mf4_file_list, chunk_rows)
+            return
+
+        workers = self._worker_count("convert_workers", "0")
+
+        if workers == 1 or len(mf4_file_list) < 2:
+            for file_idx, file in enumerate(mf4_file_list):
+                # clear the output textbox
+                self._comm.send_command("CLS")
+                self._comm.send_to_print(f" - Converting: {file}")
+                try:
+                    converted_signals = self._convert_mf4(file, file_idx)
+
+                except Exception as e:
+                    self._conversion_failed(file, file_idx, e)
+                    continue
+
+                yield file_idx, file, converted_signals, True
 
-        # thread end check
-        if self._stop_event.is_set():
-            with lock:
-                print("Aggregation thread stopped.")
             return
 
-        num_rows = df.shape[0]
-
-        if num_rows > 0:
-            sig_name = df.columns.values[0]
-            with lock:
-                self._comm.send_to_print(f"     > started aggregating signal: {sig_name}")
-            # create an array of indexes to use as a mask for the dataframe
-            idx_array = []
-            # insert first index into the array
-            previous = 0
-            idx_array.append(previous)
-            # iterate through indexes and store them only if the value changes,
-            # or if the time gap exceeds given seconds
-            for idx in range(num_rows):
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_decode_worker, initargs=(self._dbc_paths(), self._dbc_cache_path(), self._signal_patterns(), self._decoded_cache))
+        pending = deque()
+        next_idx = 0
+        try:
+            while next_idx < len(mf4_file_list) or len(pending) > 0:
+                # keep a bounded window of submitted files, so decoded files don't pile up in memory
+                while next_idx < len(mf4_file_list) and len(pending) < 2 * workers:
+                    pending.append(pool.submit(decode_mf4_worker, mf4_file_list[next_idx]))
+                    next_idx += 1
+
+                file_idx = next_idx - len(pending)
+                file = mf4_file_list[file_idx]
+                future = pending.popleft()
+
+                # wait for the oldest file
+                while len(wait([future], timeout=0.2).done) == 0:
+                    # thread end check
+                    if self._stop_event.is_set() or self._abort_event.is_set():
+                        yield file_idx, file, None, True
+                        return
+
+                # clear the output textbox
+                self._comm.send_command("CLS")
+                self._comm.send_to_print(f" - Converted: {file}")
+                try:
+                    converted_signals = self._extract_signals(file, future.result(), file_idx)
+
+                except Exception as e:
+                    self._conversion_failed(file, file_idx, e)
+                    continue
+
+                yield file_idx, file, converted_signals, True
+
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _get_agg_pool(self) -> ProcessPoolExecutor:
+        """Returns the aggregation worker pool, creates it on first use"""
+        if self._agg_pool is None:
+            self._agg_pool = ProcessPoolExecutor(max_workers=self._worker_count("agg_workers", "0"))
+
+        return self._agg_pool
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _worker_count(self, setting: str, default: str) -> int:
+        """Returns the number of worker processes of the given setting. Decoding and aggregation pools run
+        at the same time in the pipeline, so 0 (automatic) gives each of them half of the CPU cores."""
+        workers = int(self._config["settings"].get(setting, default))
+        if workers <= 0:
+            workers = max((os.cpu_count() or 1) // 2, 1)
+
+        return workers
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _close_agg_pool(self) -> None:
+        """Shuts down the aggregation worker pool, pending signals are cancelled"""
+        if self._agg_pool is not None:
+            self._agg_pool.shutdown(wait=True, cancel_futures=True)
+            self._agg_pool = None
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _aggregate(self, signals: list, file_idx: int) -> list:
+        """Aggregates input signal dataframes by removing redundant values. Signals are processed
+        by a pool of worker processes, or in this thread if only one worker is configured. Aggregation
+        state of every (device, signal) carries over to the next chunk and the next file of the device."""
+
+        self._num_of_agged_signals = 0
+        max_skip_ns = int(self._config["settings"]["agg_max_skip_seconds"]) * 1_000_000_000
+        results = [None] * len(signals)
+        pending = {}
+
+        # prepend rows left pending by the previous chunk of the device
+        device_id = self._file_devices.get(file_idx)
+        aggregators = []
+        for df in signals:
+            key = (device_id, df.columns.values[0])
+            method = self._agg_method(key[1])
+            aggregator = self._aggregators.get(key)
+            if aggregator is not None and (aggregator.method != method or not aggregator.continues(df)):
+                # changed method or data going back in time, the signal starts again
+                results.append(aggregator.flush())
+                aggregator = None
+            if aggregator is None:
+                aggregator = self._aggregators[key] = SignalAggregator(key[1], method)
+            aggregators.append(aggregator)
+        signals = [aggregator.extend(df) for aggregator, df in zip(aggregators, signals)]
+        # empty signals are skipped and never reach the progress update
+        self._num_of_signals = sum(1 for df in signals if df.shape[0] > 0)
+
+        if self._worker_count("agg_workers", "0") == 1:
+            buffer = SharedSignalBuffer([])
+        else:
+            buffer = SharedSignalBuffer(signals)
+
+        try:
+            for sig_idx, df in enumerate(signals):
+                # empty signals are not uploaded
+                if df.shape[0] == 0:
+                    continue
+
+                self._comm.send_to_print(f"     > started aggregating signal: {df.columns.values[0]}")
+
+                if buffer.shared(sig_idx):
+                    future = self._get_agg_pool().submit(aggregate_shared, *buffer.task(sig_idx), max_skip_ns,
+                                                         *aggregators[sig_idx].state(), False)
+                    pending[future] = sig_idx
+                    continue
+
                 # thread end check
                 if self._stop_event.is_set():
-                    with lock:
-                        print("Aggregation thread stopped.")
-                    return
+                    print("Aggregation stopped.")
+                    return None
 
-                time_diff = df.index[idx] - df.index[previous]
-                if (df.iat[previous, 0] != df.iat[idx, 0]):
-                    idx_array.append(idx-1)
-                    idx_array.append(idx)
-                    previous = idx
-                elif (time_diff > timedelta(seconds=int(self._config["settings"]["agg_max_skip_seconds"]))):
-                    idx_array.append(idx)
-                    previous = idx
+                result = aggregate_chunk(df.iloc[:, 0].to_numpy(), time_stamps_ns(df.index), max_skip_ns,
+                                         *aggregators[sig_idx].state(), False)
+                results[sig_idx] = aggregators[sig_idx].update(df, result, False)
+                self._aggregate_done(df.columns.values[0], file_idx)
 
-            # add last item into the mask
-            idx_array.append(num_rows - 1)
-            # create a new dataframe and remove duplicates
-            result_df = df.iloc[list(dict.fromkeys(idx_array))]
+            for future in as_completed(pending):
+                # thread end check
+                if self._stop_event.is_set():
+                    print("Aggregation stopped.")
+                    self._close_agg_pool()
+                    return None
+
+                sig_idx = pending[future]
+                results[sig_idx] = aggregators[sig_idx].update(signals[sig_idx], future.result(), False)
+                self._aggregate_done(signals[sig_idx].columns.values[0], file_idx)
+
+        finally:
+            buffer.release()
 
+        return [df for df in results if df is not None]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _rollup(self, signals: list, file_idx: int) -> list:
+        """Computes rollup statistics of numeric signals for every configured resolution. Returns a list
+        of (signal, resolution, dataframe) with completed buckets, open buckets carry over to the next chunk."""
+        device_id = self._file_devices.get(file_idx)
+        results = []
+
+        for df in signals:
             # thread end check
             if self._stop_event.is_set():
-                with lock:
-                    print("Aggregation thread stopped.")
-                return
-            
-            # safely store the aggregated signal
-            with lock:
-                dfs.append(result_df)
-                self._comm.send_to_print(f"     = finished agg. signal: {sig_name}")
-                # update the progress bar
-                self._num_of_agged_signals += 1
-                self._comm.send_command(f"PROG#{round(((self._num_of_done_files + 1/3 + ((1/3) * (self._num_of_agged_signals / self._num_of_signals))) / self._num_of_files), 3)}")
+                print("Rollup stopped.")
+                return None
+
+            if df.shape[0] == 0 or not isinstance(df.dtypes.iloc[0], np.dtype) or df.dtypes.iloc[0].kind not in "iuf":
+                continue
+
+            signal = df.columns.values[0]
+            for resolution in self._rollup_resolutions:
+                stats = self._rollups.setdefault((device_id, signal, resolution), SignalRollup(resolution)).update(df)
+                if stats.shape[0] > 0:
+                    results.append((signal, resolution, stats))
+
+        return results
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _finish_rollups(self) -> dict:
+        """Closes open buckets of all rollups at the end of the run. Returns their statistics by device."""
+        results = {}
+        for (device_id, signal, resolution), signal_rollup in self._rollups.items():
+            stats = signal_rollup.flush()
+            if stats is not None:
+                results.setdefault(device_id, []).append((signal, resolution, stats))
+
+        self._rollups.clear()
+        return results
+
+# --------------------------------------------------------------------------------------------------------------------------------
 
+    def _finish_aggregation(self) -> dict:
+        """Ends aggregation of the run. Pending last samples are either stored to continue in the next run,
+        or returned by device to be uploaded."""
+        if self._config["settings"].get("agg_keep_state", "false") == "true":
+            try:
+                save_aggregators(self._aggregators, AGG_STATE_PATH)
+                self._aggregators.clear()
+                return {}
+
+            except Exception as e:
+                self._comm.send_error("WARNING", f"Can't store aggregation state, uploading the last samples:\n{e}", "F")
+
+        results = {}
+        for (device_id, signal), aggregator in self._aggregators.items():
+            df = aggregator.flush()
+            if df is not None:
+                results.setdefault(device_id, []).append(df)
+
+        self._aggregators.clear()
+        return results
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _load_aggregation(self) -> None:
+        """Loads aggregation state stored by the previous run if requested. The file is replaced only at the end
+        of a completed run, files of a stopped run are not moved (see _hold_file), so they continue from the same state."""
+        self._aggregators.clear()
+        if self._config["settings"].get("agg_keep_state", "false") != "true":
+            return
+
+        # the clean upload erases the data the stored state continues from
+        if self._config["settings"]["clean_upload"] == "true":
             return
 
+        try:
+            self._aggregators.update(load_aggregators(AGG_STATE_PATH))
+
+        except Exception as e:
+            self._comm.send_error("WARNING", f"Can't load aggregation state, aggregation starts again:\n{e}", "F")
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _aggregate_done(self, sig_name: str, file_idx: int) -> None:
+        self._comm.send_to_print(f"     = finished agg. signal: {sig_name}")
+        # update the progress bar
+        self._num_of_agged_signals += 1
+        self._report_progress(file_idx, 1/3 + ((1/3) * (self._num_of_agged_signals / self._num_of_signals)))
+        return
+
 # --------------------------------------------------------------------------------------------------------------------------------          
 
-    def _split_df_by_cols(self, df) -> list:
+    def _split_df_by_cols(self, df, file_idx: int) -> list:
         """Extracts and returns individual signals from given converted physica-value-dataframe"""
         column_df = []
 
         if not 'Signal' in df.columns:
             # No signals were converted
             # update progress bar
-            self._comm.send_command(f"PROG#{round(((self._num_of_done_files + 1/3) / self._num_of_files), 3)}")
+            self._report_progress(file_idx, 1/3)
             return column_df
         
         try:
-            for sig_count, signal_name in enumerate(df['Signal'].unique()):
+            # sort the frame by signal only once, the stable sort keeps time order within each signal
+            codes, signal_names = pd.factorize(df['Signal'])
+            order = np.argsort(codes, kind="stable")
+            bounds = np.searchsorted(codes[order], np.arange(len(signal_names) + 1))
+            values = df['Physical Value'].to_numpy()[order]
+            index = df.index[order]
+
+            for sig_count, signal_name in enumerate(signal_names):
                 # thread end check
                 if self._stop_event.is_set():
                     print("Conversion aborted.")
                     return None
 
-                signal_df = df[df['Signal'] == signal_name][['Physical Value']].copy()
-                signal_df.rename(columns={'Physical Value': signal_name}, inplace=True)
+                # every signal is a contiguous slice (view) of the sorted arrays
+                start, end = bounds[sig_count], bounds[sig_count + 1]
+                signal_df = pd.DataFrame({signal_name: values[start:end]}, index=index[start:end], copy=False)
                 column_df.append(signal_df)
                 # update progress bar
-                self._comm.send_command(f"PROG#{round(((self._num_of_done_files + ((1/3) * (sig_count / len(df['Signal'].unique())))) / self._num_of_files), 3)}")
+                self._report_progress(file_idx, (1/3) * (sig_count / len(signal_names)))
 
         except Exception as e:
             self._comm.send_error("ERROR", f"Can't split df:\n{e}", "T")
@@ -253,107 +631,278 @@ class Conversion():
 
 # --------------------------------------------------------------------------------------------------------------------------------
 
-    def process_handle(self) -> None:
-        """Function that handles MF4 files process from conversion to upload"""
+    def _report_progress(self, file_idx: int, fraction: float) -> None:
+        """Stores progress of one file (0 - 1) and sends the overall progress of all files to the GUI"""
+        with self._progress_lock:
+            # files converted in chunks go through the stages repeatedly, the progress never goes back
+            self._file_progress[file_idx] = max(self._file_progress[file_idx], fraction)
+            total = sum(self._file_progress) / self._num_of_files
+            # sent under the lock, so the progress never goes back in the GUI
+            self._comm.send_command(f"PROG#{round(total, 3)}")
 
-        self._comm.send_command("START")
+        return
 
-        # load DBC files
-        self._dbc_list = self.create_dbc_list()
+# --------------------------------------------------------------------------------------------------------------------------------
 
-        # prepare the database
-        self._db.connect()
-        self._db.create_schema()
+    def _queue_put(self, stage_queue: queue.Queue, item) -> bool:
+        """Puts item into the queue between two stages, waits while the queue is full. Returns False on abort."""
+        while not (self._stop_event.is_set() or self._abort_event.is_set()):
+            try:
+                stage_queue.put(item, timeout=0.2)
+                return True
 
-        # thread end check
-        if self._stop_event.is_set():
-            print("Process thread stopped.")
-            return
+            except queue.Full:
+                continue
 
-        # load MF4 files
-        mf4_file_list, self._num_of_files = self._utils.get_MF4_files(self._config["settings"]["mf4_path"])
-        self._num_of_done_files = 0
+        return False
 
-        try: 
-            for file in mf4_file_list:
-                # clear the output textbox
-                self._comm.send_command("CLS")
+# --------------------------------------------------------------------------------------------------------------------------------
 
-                # thread end check
-                if self._stop_event.is_set():
-                    print("Process thread stopped.")
-                    return
+    def _queue_get(self, stage_queue: queue.Queue):
+        """Takes the next item from the queue between two stages. Returns None at the end of the files or on abort."""
+        while not (self._stop_event.is_set() or self._abort_event.is_set()):
+            try:
+                return stage_queue.get(timeout=0.2)
 
-                # CONVERT FILE into Signal files
-                self._comm.send_to_print(f" - Converting: {file}")
-            
-                dfs_to_upload = []
-                converted_signals = self._convert_mf4(file)
-                self._num_of_signals = len(converted_signals)
-                self._num_of_agged_signals = 0
+            except queue.Empty:
+                continue
+
+        return None
+
+# --------------------------------------------------------------------------------------------------------------------------------
 
+    def _decode_stage(self, mf4_file_list: list, out_queue: queue.Queue) -> None:
+        """First pipeline stage - reads and decodes MF4 files into signal dataframes"""
+        try:
+            # CONVERT FILES into Signal files
+            for file_idx, file, converted_signals, last_chunk in self._decoded_files(mf4_file_list):
                 # thread end check
                 if self._stop_event.is_set():
-                    print("Process thread stopped.")
+                    print("Decode stage stopped.")
+                    return
+
+                if converted_signals is None or not self._queue_put(out_queue, (file_idx, file, converted_signals, last_chunk)):
+                    print("Decode stage stopped.")
                     return
 
+            # end of files
+            self._queue_put(out_queue, None)
+
+        except Exception as e:
+            self._abort_event.set()
+            self._comm.send_error("ERROR", f"Process error:\n{e}", "T")
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _aggregate_stage(self, in_queue: queue.Queue, out_queue: queue.Queue) -> None:
+        """Second pipeline stage - aggregates decoded signals and computes their rollups if requested"""
+        try:
+            while True:
+                item = self._queue_get(in_queue)
+                if item is None:
+                    break
+
+                file_idx, file, converted_signals, last_chunk = item
+
                 # AGGREGATE if requested
                 if self._config["settings"]["aggregate"] == "true":
-                    agg_threads = []
-                    self._comm.send_to_print("   - aggregating...")
-                    # run each signal in a different thread
-                    lock = Lock()
-                    for signal_df in converted_signals:
-                        # thread end check
-                        if self._stop_event.is_set():
-                            print("Process thread stopped.")
-                            return None
-
-                        thread = threading.Thread(target=self._aggregate, args=(signal_df, lock, dfs_to_upload))
-                        thread.start()
-                        agg_threads.append(thread)
-                        self._threads.append(thread)
-                    
-                    # wait for aggregation threads to finish
-                    for thr in agg_threads:
-                        thr.join()
+                    self._comm.send_to_print(f"   - aggregating: {file}")
+                    dfs_to_upload = self._aggregate(converted_signals, file_idx)
+
+                    # thread end check
+                    if dfs_to_upload is None or self._stop_event.is_set():
+                        print("Aggregation stage stopped.")
+                        return
                 
                 else:
                     # update progress bar
-                    self._comm.send_command(f"PROG#{round(((self._num_of_done_files + 2/3) / self._num_of_files), 3)}")
+                    self._report_progress(file_idx, 2/3)
                     # assign dataframes to upload
                     dfs_to_upload = converted_signals
 
-                # thread end check
-                if self._stop_event.is_set():
-                    print("Process thread stopped.")
+                # ROLLUP from full resolution data
+                rollups = self._rollup(converted_signals, file_idx)
+                if rollups is None:
+                    print("Aggregation stage stopped.")
                     return
 
-                # UPLOAD TO DB
-                self._comm.send_to_print("   - uploading...")
-                self._db.upload_data(dfs_to_upload, self._num_of_done_files, self._num_of_files)
-
-                # thread end check
-                if self._stop_event.is_set():
-                    print("Process thread stopped.")
+                device_id = self._file_devices.get(file_idx)
+                if not self._queue_put(out_queue, (file_idx, file, device_id, dfs_to_upload, rollups, last_chunk)):
+                    print("Aggregation stage stopped.")
                     return
-    
-                # MOVE DONE FILES if requested
-                if self._config["settings"]["move_done_files"] == "true":
+
+            # end of files
+            if not (self._stop_event.is_set() or self._abort_event.is_set()):
+                # last samples and open buckets of all signals, not related to any file
+                last_samples = self._finish_aggregation() if self._config["settings"]["aggregate"] == "true" else {}
+                last_buckets = self._finish_rollups()
+                for device_id in set(last_samples) | set(last_buckets):
+                    self._queue_put(out_queue, (None, None, device_id, last_samples.get(device_id, []), last_buckets.get(device_id, []), True))
+                self._queue_put(out_queue, None)
+
+        except Exception as e:
+            self._abort_event.set()
+            self._comm.send_error("ERROR", f"Process error:\n{e}", "T")
+
+        finally:
+            self._close_agg_pool()
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _upload_stage(self, in_queue: queue.Queue) -> bool:
+        """Last pipeline stage - uploads signals to the database (or another sink) and moves done files. Returns True if all files were processed."""
+        while True:
+            item = self._queue_get(in_queue)
+            if item is None:
+                completed = not (self._stop_event.is_set() or self._abort_event.is_set())
+                if completed:
+                    self._move_held_files()
+                return completed
+
+            file_idx, file, device_id, dfs_to_upload, rollups, last_chunk = item
+
+            if file is None:
+                # last samples of aggregated signals and last buckets of rollups
+                if len(dfs_to_upload) > 0:
+                    self._comm.send_to_print("   - uploading last samples of aggregated signals...")
+                    self._sink.upload_data(dfs_to_upload, lambda part: None, device_id)
+                if len(rollups) > 0:
+                    self._comm.send_to_print("   - uploading last rollup buckets...")
+                    self._sink.upload_rollups(rollups, device_id)
+                continue
+
+            # UPLOAD TO DB
+            self._comm.send_to_print(f"   - uploading: {file}")
+            self._sink.upload_data(dfs_to_upload, lambda part: self._report_progress(file_idx, 2/3 + ((1/3) * part)), device_id)
+            if len(rollups) > 0:
+                self._sink.upload_rollups(rollups, device_id)
+
+            # thread end check
+            if self._stop_event.is_set():
+                print("Process thread stopped.")
+                return False
+
+            # the file is done with its last chunk, files which failed to convert are left in place
+            if not last_chunk or file_idx in self._failed_files:
+                continue
+
+            # MOVE DONE FILES if requested
+            if self._config["settings"]["move_done_files"] == "true":
+                if self._hold_file():
+                    self._held_files.append(file)
+                else:
                     self._comm.send_to_print("   - moving the file...")
                     self._utils.move_done_file(file, self._config["settings"]["mf4_path"], self._config["settings"]["done_path"])
 
-                self._comm.send_to_print(f"   - DONE!")
-                self._comm.send_to_print()
+            self._comm.send_to_print(f"   - DONE: {file}")
+            self._comm.send_to_print()
+
+            # update the number of done files
+            self._num_of_done_files += 1
+            self._report_progress(file_idx, 1)
 
-                # update the number of done files
-                self._num_of_done_files += 1
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _hold_file(self) -> bool:
+        """Returns True if done files have to stay in place until the end of the run. Pending samples of aggregated
+        signals and open rollup buckets are stored only then, a stopped run would lose them with moved files."""
+        return self._config["settings"]["aggregate"] == "true" or len(self._rollup_resolutions) > 0
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _move_held_files(self) -> None:
+        """Moves done files held back until the end of the run"""
+        if len(self._held_files) > 0:
+            self._comm.send_to_print(f"   - moving {len(self._held_files)} done file(s)...")
+        for file in self._held_files:
+            self._utils.move_done_file(file, self._config["settings"]["mf4_path"], self._config["settings"]["done_path"])
+
+        self._held_files.clear()
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def process_handle(self) -> None:
+        """Function that handles MF4 files process from conversion to upload. Files flow through a pipeline
+        of decode, aggregate and upload stages, so the next file is decoded while the previous one uploads."""
+
+        self._comm.send_command("START")
+
+        # select the storage
+        self._sink = self._create_sink()
+        if self._sink is None:
+            return
+
+        # load DBC files
+        self._dbc_list = self.create_dbc_list()
+        self._decoded_cache = self._load_decoded_cache()
+
+        # load aggregation methods
+        if not self._load_agg_methods() or not self._load_rollup_resolutions():
+            return
+
+        # load DBC messages of message tables
+        if not self._load_signal_messages():
+            return
+
+        # prepare the storage
+        self._sink.connect()
+        self._sink.create_schema()
+
+        # thread end check
+        if self._stop_event.is_set():
+            print("Process thread stopped.")
+            return
+
+        # load MF4 files
+        mf4_file_list, self._num_of_files = self._utils.get_MF4_files(self._config["settings"]["mf4_path"])
+        self._num_of_done_files = 0
+        self._num_of_failed_files = 0
+        self._failed_files.clear()
+        self._held_files.clear()
+        self._file_devices.clear()
+        self._load_aggregation()
+        self._rollups.clear()
+        self._file_progress = [0] * self._num_of_files
+        self._abort_event.clear()
+
+        # bounded queues between the stages limit the number of decoded files held in memory
+        depth = max(int(self._config["settings"].get("pipeline_depth", "1")), 1)
+        decoded_queue = queue.Queue(maxsize=depth)
+        aggregated_queue = queue.Queue(maxsize=depth)
+
+        stages = [threading.Thread(target=self._decode_stage, args=(mf4_file_list, decoded_queue)),
+                  threading.Thread(target=self._aggregate_stage, args=(decoded_queue, aggregated_queue))]
+        for thread in stages:
+            thread.start()
+            self._threads.append(thread)
+
+        completed = False
+        try:
+            completed = self._upload_stage(aggregated_queue)
 
         except Exception as e:
             self._comm.send_error("ERROR", f"Process error:\n{e}", "T")
             return
 
+        finally:
+            # unblock the other stages if the upload ended early and wait for them
+            if not completed:
+                self._abort_event.set()
+            for thread in stages:
+                thread.join()
+
+        if not completed:
+            print("Process thread stopped.")
+            return
+
         self._comm.send_to_print()
+        if self._num_of_failed_files > 0:
+            self._comm.send_to_print(f"WARNING: {self._num_of_failed_files} MF4 file(s) could not be converted and were skipped.")
         self._comm.send_to_print("                                      ~ ")           
         self._comm.send_to_print("Everything completed successfully!  c[_]")
         self._comm.send_to_print()
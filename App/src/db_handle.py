@@ -9,15 +9,40 @@ from sqlalchemy.exc import IntegrityError, ProgrammingError
 from sqlalchemy import create_engine, schema, inspect
 from sqlalchemy.sql import text
 from .communication import PipeCommunication
+from .sink import DataSink
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import itertools
+import csv
+import io
+import os
+
+# rollup tables are named <signal>@<resolution>
+ROLLUP_SEPARATOR = "@"
+# uploaded parts of rollup buckets of all rollup tables, the separator keeps it out of signal lists
+ROLLUP_PARTS_TABLE = f"{ROLLUP_SEPARATOR}rollup_parts"
+
+# rows fetched from the server-side cursor at once during export
+EXPORT_BATCH_ROWS = 10000
+EXCEL_MAX_ROWS = 1048576
+# columnar export formats, written batch by batch
+COLUMNAR_FORMATS = ("parquet", "feather")
+# arrow types of postgres column types (by type oid) in exported files
+ARROW_TYPES = {16: pa.bool_(), 20: pa.int64(), 21: pa.int16(), 23: pa.int32(), 700: pa.float32(), 701: pa.float64(),
+               25: pa.string(), 1043: pa.string(), 1114: pa.timestamp("us"), 1184: pa.timestamp("us", tz="UTC")}
 
 # ================================================================================================================================
 # ================================================================================================================================
 
-class DatabaseHandle:
+class DatabaseHandle(DataSink):
     def __init__(self, config, communication: PipeCommunication, event):
         self._comm = communication
         self._stop_event = event
+        self._engine = None
+        self._engine_key = None
+        # connection of the conversion, signal fetching and downloads use their own ones
+        self._connection = None
         
         try:
             self._schema_name = config["database"]["schema_name"]
@@ -26,6 +51,10 @@ class DatabaseHandle:
             self._database = config["database"]["database"]
             self._user = config["database"]["user"]
             self._password = config["database"]["password"]
+            self._upload_mode = config["database"].get("upload_mode", "copy")
+            self._table_index = config["database"].get("table_index", "primary_key")
+            self._layout = config["database"].get("layout", "signal_tables")
+            self._pool_size = int(config["database"].get("pool_size", "5"))
 
             if config["settings"]["clean_upload"] == "true":
                 self._clean = True
@@ -37,6 +66,14 @@ class DatabaseHandle:
             return
 
         self._conn_string = "postgresql://" + self._user + ":" + self._password + "@" + self._host + ":" + self._port + "/" + self._database
+        self._tables = set()
+        self._signal_ids = {}
+        self._partitioned = False
+        self._signal_messages = {}
+        self._table_columns = {}
+        self._device_tables = set()
+        self._rollup_tables = set()
+        self._keyed_tables = set()
         
 # --------------------------------------------------------------------------------------------------------------------------------
 
@@ -72,14 +109,32 @@ class DatabaseHandle:
 
         return []
 
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _get_engine(self):
+        """Returns the pooled engine of current connection parameters. The engine lives across conversions,
+        signal fetching and downloads, a new one is created only when the parameters change."""
+        engine_key = (self._conn_string, self._pool_size)
+        if self._engine is None or self._engine_key != engine_key:
+            if self._engine is not None:
+                self._engine.dispose()
+
+            # pre-ping replaces connections dropped by the server while idle in the pool
+            self._engine = create_engine(self._conn_string, pool_pre_ping=True, pool_size=self._pool_size)
+            self._engine_key = engine_key
+
+        return self._engine
+
 # --------------------------------------------------------------------------------------------------------------------------------
 
     def connect(self) -> None:
         """Function to handle database connection procedure"""
         try:
             self._comm.send_to_print("Connecting to the database ...  ", end='')
-            self._engine = create_engine(self._conn_string)
-            self._connection = self._engine.connect()
+            # the connection of the previous conversion returns to the pool
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = self._get_engine().connect()
             self._comm.send_to_print("done!")
 
         except Exception as e:
@@ -101,31 +156,68 @@ class DatabaseHandle:
                 self._connection.execute(schema.CreateSchema(self._schema_name))
                 self._connection.commit()
 
+            # cache existing signal tables for this run
+            self._tables = set(inspect(self._connection).get_table_names(schema=self._schema_name))
+            self._signal_ids = {}
+            self._table_columns = {}
+            self._rollup_tables = set()
+            self._keyed_tables = set()
+
+            # tables created before the device id was stored are migrated on their first upload
+            rows = self._connection.execute(text("SELECT table_name FROM information_schema.columns WHERE table_schema = :schema "
+                                                 "AND column_name = 'device_id'"), {"schema": self._schema_name}).fetchall()
+            self._device_tables = set(row[0] for row in rows)
+
+            if self._layout == "long":
+                self._provision_long_layout()
+
         except Exception as e:
             self._comm.send_error("ERROR", f"Error with DB schema:\n{e}", "T")
     
 # --------------------------------------------------------------------------------------------------------------------------------
 
-    def upload_data(self, data: list, done_files: int, num_files: int) -> None:
-        """Uploads given list of dataframes to the database"""
+    def upload_data(self, data: list, progress: callable, device_id: str = None) -> None:
+        """Uploads given list of dataframes to the database. Progress callback receives uploaded part of the data (0 - 1)."""
+        if self._layout == "long":
+            self._upload_long(data, progress, device_id)
+            return
+
+        if self._layout == "message_tables":
+            self._upload_messages(data, progress, device_id)
+            return
+
+        raw_connection = None
+        try:
+            if self._upload_mode == "copy":
+                raw_connection = self._engine.raw_connection()
+
+        except Exception as e:
+            self._comm.send_error("WARNING", f"Problem with DB upload:\n{e}", "F")
+            return
+
         for df_count, df in enumerate(data):
              # thread end check
             if self._stop_event.is_set():
                 print("Database upload aborted.")
-                return
+                break
 
             try:
                 table_name = f"{df.columns.values[0]}"
                 self._comm.send_to_print(f"     > uploading signal: {table_name}")
-                df.to_sql(name=table_name,
-                            con=self._engine,
-                            schema=self._schema_name,
-                            index=True,
-                            index_label="time_stamp",
-                            if_exists="append")
-                self._connection.commit()
-                # set primary key
-                self.querry(f'ALTER TABLE {self._schema_name}."{table_name}" ADD PRIMARY KEY (time_stamp)', False)
+
+                self._provision_table(df, table_name)
+
+                if raw_connection is not None:
+                    self._copy_data(raw_connection, df, table_name, device_id)
+
+                else:
+                    df.assign(device_id=device_id if device_id is not None else "").to_sql(name=table_name,
+                                con=self._connection,
+                                schema=self._schema_name,
+                                index=True,
+                                index_label="time_stamp",
+                                if_exists="append")
+                    self._connection.commit()
 
             except IntegrityError:
                 self._comm.send_to_print("       - WARNING: Skipping signal upload due to unique violation. This record already exists in the DB.")
@@ -134,16 +226,514 @@ class DatabaseHandle:
                 self._comm.send_error("WARNING", f"Problem with DB upload:\n{e}", "F")
 
             # update progress bar
-            # adding 2/3 because database upload is the third part of the process
-            self._comm.send_command(f"PROG#{round(((done_files + 2/3 + ((1/3) * (df_count / len(data)))) / num_files), 3)}")
+            progress(df_count / len(data))
+
+        if raw_connection is not None:
+            raw_connection.close()
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _provision_long_layout(self) -> None:
+        """Creates the signal dictionary and the narrow signal_data table of the long layout. The data table
+        is a TimescaleDB hypertable if the extension is available, otherwise it is partitioned by month."""
+        self.querry(f"CREATE TABLE IF NOT EXISTS {self._schema_name}.signal_dict (signal_id SMALLINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY, "
+                    "signal_name TEXT NOT NULL UNIQUE)", False)
+
+        if "signal_data" not in self._tables:
+            if len(self.querry("SELECT 1 FROM pg_available_extensions WHERE name = 'timescaledb'", True) or []) > 0:
+                self.querry("CREATE EXTENSION IF NOT EXISTS timescaledb", False)
+
+            columns = ("time_stamp TIMESTAMP WITH TIME ZONE NOT NULL, device_id TEXT NOT NULL DEFAULT '', signal_id SMALLINT NOT NULL, "
+                       "value DOUBLE PRECISION, PRIMARY KEY (signal_id, time_stamp, device_id)")
+
+            if len(self.querry("SELECT 1 FROM pg_extension WHERE extname = 'timescaledb'", True) or []) > 0:
+                self._comm.send_to_print(" - Creating signal_data hypertable")
+                self.querry(f"CREATE TABLE IF NOT EXISTS {self._schema_name}.signal_data ({columns})", False)
+                self.querry(f"SELECT create_hypertable('{self._schema_name}.signal_data', 'time_stamp', if_not_exists => TRUE)", True)
+            else:
+                self._comm.send_to_print(" - Creating partitioned signal_data table")
+                self.querry(f"CREATE TABLE IF NOT EXISTS {self._schema_name}.signal_data ({columns}) PARTITION BY RANGE (time_stamp)", False)
+
+            self._tables.add("signal_data")
+
+        self._provision_keys("signal_data", "signal_id, time_stamp, device_id", "signal_id, device_id, time_stamp")
+
+        # a hypertable creates its chunks itself, partitions have to be created on demand
+        partitioned = self.querry(f"SELECT 1 FROM pg_partitioned_table WHERE partrelid = '{self._schema_name}.signal_data'::regclass", True)
+        self._partitioned = partitioned is not None and len(partitioned) > 0
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _provision_partitions(self, time_stamps: pd.Series) -> None:
+        """Creates monthly partitions of the signal_data table covering given time stamps"""
+        if not self._partitioned or len(time_stamps) == 0:
+            return
+
+        utc_times = time_stamps.dt.tz_convert("UTC").dt.tz_localize(None)
+        for month in pd.period_range(utc_times.min(), utc_times.max(), freq="M"):
+            partition_name = f"signal_data_{month.strftime('%Y%m')}"
+            if partition_name in self._tables:
+                continue
+
+            start = month.start_time.strftime("%Y-%m-%d")
+            end = (month + 1).start_time.strftime("%Y-%m-%d")
+            self.querry(f"CREATE TABLE IF NOT EXISTS {self._schema_name}.{partition_name} PARTITION OF {self._schema_name}.signal_data "
+                        f"FOR VALUES FROM ('{start} 00:00:00+00') TO ('{end} 00:00:00+00')", False)
+            self._tables.add(partition_name)
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _get_signal_ids(self, signal_names: list) -> dict:
+        """Returns ids of given signals from the signal dictionary, signals not in the dictionary yet are added"""
+        missing = [name for name in signal_names if name not in self._signal_ids]
+        if len(missing) > 0:
+            with self._engine.begin() as connection:
+                connection.execute(text(f"INSERT INTO {self._schema_name}.signal_dict (signal_name) SELECT unnest(CAST(:names AS TEXT[])) "
+                                        "ON CONFLICT (signal_name) DO NOTHING"), {"names": missing})
+                rows = connection.execute(text(f"SELECT signal_name, signal_id FROM {self._schema_name}.signal_dict "
+                                               "WHERE signal_name = ANY(CAST(:names AS TEXT[]))"), {"names": missing}).fetchall()
+            self._signal_ids.update({name: signal_id for name, signal_id in rows})
+
+        return {name: self._signal_ids[name] for name in signal_names}
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _upload_long(self, data: list, progress: callable, device_id: str) -> None:
+        """Uploads given signals of one device into the signal_data table in a single COPY"""
+        signals = []
+        for df in data:
+            if df.shape[0] == 0:
+                continue
+
+            if not (pd.api.types.is_numeric_dtype(df.dtypes.iloc[0]) or pd.api.types.is_bool_dtype(df.dtypes.iloc[0])):
+                self._comm.send_to_print(f"       - WARNING: Skipping signal {df.columns.values[0]}, long layout stores numeric values only.")
+                continue
+
+            signals.append(df)
+
+        if len(signals) == 0:
+            progress(1)
+            return
+
+        raw_connection = None
+        try:
+            signal_ids = self._get_signal_ids([df.columns.values[0] for df in signals])
+
+            # one narrow frame with all signals
+            long_df = pd.concat([pd.DataFrame({"time_stamp": df.index,
+                                               "device_id": device_id if device_id is not None else "",
+                                               "signal_id": signal_ids[df.columns.values[0]],
+                                               "value": df.iloc[:, 0].astype("float64").to_numpy()}) for df in signals], ignore_index=True)
+            progress(1/2)
+
+            # thread end check
+            if self._stop_event.is_set():
+                print("Database upload aborted.")
+                return
+
+            self._comm.send_to_print(f"     > uploading {len(signals)} signals ({len(long_df)} rows)")
+            self._provision_partitions(long_df["time_stamp"])
+            raw_connection = self._engine.raw_connection()
+            self._copy_long(raw_connection, long_df)
+
+        except Exception as e:
+            self._comm.send_error("WARNING", f"Problem with DB upload:\n{e}", "F")
+
+        finally:
+            if raw_connection is not None:
+                raw_connection.close()
+
+        progress(1)
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _copy_long(self, raw_connection, long_df) -> None:
+        """Streams the narrow frame through COPY into a staging table and merges it into signal_data.
+        Rows already present in signal_data are skipped."""
+        csv_buffer = io.StringIO()
+        long_df.to_csv(csv_buffer, header=False, index=False)
+        csv_buffer.seek(0)
+
+        cursor = raw_connection.cursor()
+        try:
+            cursor.execute(f"CREATE TEMP TABLE long_stage (LIKE {self._schema_name}.signal_data INCLUDING DEFAULTS) ON COMMIT DROP")
+            cursor.copy_expert("COPY long_stage FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (device_id))", csv_buffer)
+            cursor.execute(f"INSERT INTO {self._schema_name}.signal_data SELECT * FROM long_stage ON CONFLICT DO NOTHING")
+            inserted = cursor.rowcount
+            raw_connection.commit()
+
+        except Exception:
+            raw_connection.rollback()
+            raise
+
+        finally:
+            cursor.close()
+
+        if inserted < len(long_df):
+            self._comm.send_to_print(f"       - {len(long_df) - inserted} rows already in the DB were skipped.")
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def set_signal_messages(self, signal_messages: dict) -> None:
+        """Sets the message name of every signal, used as table names of the message table layout"""
+        self._signal_messages = signal_messages
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _upload_messages(self, data: list, progress: callable, device_id: str) -> None:
+        """Uploads given signals joined into one wide table per message, with a column per signal"""
+        messages = {}
+        for df in data:
+            if df.shape[0] > 0:
+                signal_name = df.columns.values[0]
+                messages.setdefault(self._signal_messages.get(signal_name, signal_name), []).append(df)
+
+        raw_connection = None
+        try:
+            raw_connection = self._engine.raw_connection()
+
+            for msg_count, (table_name, signals) in enumerate(messages.items()):
+                # thread end check
+                if self._stop_event.is_set():
+                    print("Database upload aborted.")
+                    break
+
+                try:
+                    self._comm.send_to_print(f"     > uploading message: {table_name}")
+                    # signals of one message share time stamps, duplicated time stamps keep the first value like other layouts
+                    wide_df = pd.concat([df[~df.index.duplicated()] for df in signals], axis=1)
+                    # integer signals stay integers where other signals of the message fill the gaps
+                    for df in signals:
+                        if pd.api.types.is_integer_dtype(df.dtypes.iloc[0]):
+                            wide_df[df.columns.values[0]] = wide_df[df.columns.values[0]].astype("Int64")
+                    self._provision_message_table(wide_df, table_name)
+                    self._copy_message(raw_connection, wide_df, table_name, device_id)
+
+                except Exception as e:
+                    self._comm.send_error("WARNING", f"Problem with DB upload:\n{e}", "F")
+
+                # update progress bar
+                progress(msg_count / len(messages))
+
+        except Exception as e:
+            self._comm.send_error("WARNING", f"Problem with DB upload:\n{e}", "F")
+
+        finally:
+            if raw_connection is not None:
+                raw_connection.close()
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _provision_message_table(self, wide_df, table_name: str) -> None:
+        """Creates the message table and adds columns of signals it does not have yet"""
+        columns = self._table_columns.setdefault(table_name, set())
+        if table_name in self._tables:
+            self._migrate_device_key(table_name)
+        else:
+            self.querry(f'CREATE TABLE IF NOT EXISTS {self._schema_name}."{table_name}" (time_stamp TIMESTAMP WITH TIME ZONE NOT NULL, '
+                        "device_id TEXT NOT NULL DEFAULT '', PRIMARY KEY (time_stamp, device_id))", False)
+            self._tables.add(table_name)
+            self._device_tables.add(table_name)
+            self._provision_device_index(table_name, "device_id, time_stamp")
+            self._keyed_tables.add(table_name)
+
+        for signal_name, dtype in wide_df.dtypes.items():
+            if signal_name in columns:
+                continue
+
+            self.querry(f'ALTER TABLE {self._schema_name}."{table_name}" ADD COLUMN IF NOT EXISTS "{signal_name}" {self._sql_type(dtype)}', False)
+            columns.add(signal_name)
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _copy_message(self, raw_connection, wide_df, table_name: str, device_id: str) -> None:
+        """Streams the wide message frame through COPY into a staging table and merges it into the message table.
+        Values of existing rows are only filled where they are missing."""
+        csv_buffer = io.StringIO()
+        wide_df.assign(device_id=device_id if device_id is not None else "")[["device_id", *wide_df.columns]].to_csv(csv_buffer, header=False, index=True)
+        csv_buffer.seek(0)
+
+        columns = ", ".join(f'"{column}"' for column in wide_df.columns)
+        updates = ", ".join(f'"{column}" = COALESCE({self._schema_name}."{table_name}"."{column}", EXCLUDED."{column}")' for column in wide_df.columns)
+
+        cursor = raw_connection.cursor()
+        try:
+            cursor.execute(f'CREATE TEMP TABLE message_stage (LIKE {self._schema_name}."{table_name}" INCLUDING DEFAULTS) ON COMMIT DROP')
+            cursor.copy_expert(f"COPY message_stage (time_stamp, device_id, {columns}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (device_id))", csv_buffer)
+            cursor.execute(f'INSERT INTO {self._schema_name}."{table_name}" (time_stamp, device_id, {columns}) SELECT time_stamp, device_id, {columns} FROM message_stage '
+                           f'ON CONFLICT (device_id, time_stamp) DO UPDATE SET {updates}')
+            raw_connection.commit()
+
+        except Exception:
+            raw_connection.rollback()
+            raise
+
+        finally:
+            cursor.close()
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _message_signals(self, connection) -> dict:
+        """Returns the table of every signal column stored in the message table layout"""
+        query = text("SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = :schema "
+                     "AND column_name NOT IN ('time_stamp', 'device_id') ORDER BY table_name, ordinal_position")
+        rows = connection.execute(query, {"schema": self._schema_name}).fetchall()
+
+        # rollup tables are not signals
+        return {column_name: table_name for table_name, column_name in rows if ROLLUP_SEPARATOR not in table_name}
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def upload_rollups(self, rollups: list, device_id: str = None) -> None:
+        """Uploads rollup statistics of one device given as a list of (signal, resolution, dataframe). Every uploaded
+        part of a bucket is kept, buckets are merged from their parts, so uploading the same data again leaves
+        the rollups unchanged while parts from other runs or files add up."""
+        try:
+            raw_connection = self._engine.raw_connection()
+
+        except Exception as e:
+            self._comm.send_error("WARNING", f"Problem with DB rollup upload:\n{e}", "F")
+            return
+
+        for signal, resolution, df in rollups:
+            # thread end check
+            if self._stop_event.is_set():
+                print("Database upload aborted.")
+                break
+
+            try:
+                table_name = f"{signal}{ROLLUP_SEPARATOR}{resolution}"
+                self._provision_rollup_table(table_name)
+                self._copy_rollup(raw_connection, df, table_name, device_id)
+
+            except Exception as e:
+                self._comm.send_error("WARNING", f"Problem with DB rollup upload:\n{e}", "F")
+
+        raw_connection.close()
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _provision_rollup_table(self, table_name: str) -> None:
+        """Creates the rollup table and the table of bucket parts if they are not in the table cache"""
+        if ROLLUP_PARTS_TABLE not in self._tables:
+            self.querry(f'CREATE TABLE IF NOT EXISTS {self._schema_name}."{ROLLUP_PARTS_TABLE}" (rollup TEXT NOT NULL, '
+                        """time_stamp TIMESTAMP WITH TIME ZONE NOT NULL, device_id TEXT NOT NULL DEFAULT '', first_time TIMESTAMP WITH TIME ZONE NOT NULL, """
+                        'last_time TIMESTAMP WITH TIME ZONE, "min" DOUBLE PRECISION, "max" DOUBLE PRECISION, "avg" DOUBLE PRECISION, "count" BIGINT, '
+                        '"first" DOUBLE PRECISION, "last" DOUBLE PRECISION, PRIMARY KEY (rollup, time_stamp, device_id, first_time))', False)
+            self._tables.add(ROLLUP_PARTS_TABLE)
+
+        if table_name in self._tables:
+            self._migrate_device_key(table_name)
+            if table_name not in self._rollup_tables:
+                # rollup tables created before the first and last times were stored
+                self.querry(f'ALTER TABLE {self._schema_name}."{table_name}" ADD COLUMN IF NOT EXISTS first_time TIMESTAMP WITH TIME ZONE, '
+                            'ADD COLUMN IF NOT EXISTS last_time TIMESTAMP WITH TIME ZONE', False)
+                self._rollup_tables.add(table_name)
+            return
+
+        self.querry(f'CREATE TABLE IF NOT EXISTS {self._schema_name}."{table_name}" (time_stamp TIMESTAMP WITH TIME ZONE NOT NULL, '
+                    """device_id TEXT NOT NULL DEFAULT '', "min" DOUBLE PRECISION, "max" DOUBLE PRECISION, "avg" DOUBLE PRECISION, """
+                    '"count" BIGINT, "first" DOUBLE PRECISION, "last" DOUBLE PRECISION, first_time TIMESTAMP WITH TIME ZONE, '
+                    'last_time TIMESTAMP WITH TIME ZONE, PRIMARY KEY (time_stamp, device_id))', False)
+
+        self._tables.add(table_name)
+        self._rollup_tables.add(table_name)
+        self._device_tables.add(table_name)
+        self._provision_device_index(table_name, "device_id, time_stamp")
+        self._keyed_tables.add(table_name)
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _copy_rollup(self, raw_connection, df, table_name: str, device_id: str) -> None:
+        """Streams rollup statistics through COPY into a staging table, stores them as bucket parts and recomputes
+        the affected buckets of the rollup table from all their parts. A part is identified by the time of its first
+        value, an upload of the same part replaces it. Buckets without values are skipped."""
+        df = df[df["count"] > 0]
+        if df.shape[0] == 0:
+            return
+
+        csv_buffer = io.StringIO()
+        df.assign(device_id=device_id if device_id is not None else "")[["device_id", *df.columns]].to_csv(csv_buffer, header=False, index=True)
+        csv_buffer.seek(0)
+
+        parts = f'{self._schema_name}."{ROLLUP_PARTS_TABLE}"'
+        columns = ", ".join(f'"{column}"' for column in df.columns)
+        updates = ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in df.columns if column != "first_time")
+        # first and last values are taken from the parts with the earliest and the latest time
+        merged = ('MIN("min"), MAX("max"), SUM("avg" * "count") / NULLIF(SUM("count"), 0), SUM("count"), '
+                  '(ARRAY_AGG("first" ORDER BY first_time))[1], (ARRAY_AGG("last" ORDER BY last_time DESC NULLS LAST))[1], '
+                  'MIN(first_time), MAX(last_time)')
+        cursor = raw_connection.cursor()
+        try:
+            cursor.execute(f'CREATE TEMP TABLE rollup_stage (LIKE {self._schema_name}."{table_name}" INCLUDING DEFAULTS) ON COMMIT DROP')
+            cursor.copy_expert(f"COPY rollup_stage (time_stamp, device_id, {columns}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (device_id))", csv_buffer)
+            cursor.execute(f'INSERT INTO {parts} (rollup, time_stamp, device_id, {columns}) SELECT %s, time_stamp, device_id, {columns} '
+                           f'FROM rollup_stage ON CONFLICT (rollup, time_stamp, device_id, first_time) DO UPDATE SET {updates}', (table_name,))
+            cursor.execute(f'INSERT INTO {self._schema_name}."{table_name}" (time_stamp, device_id, {columns}) '
+                           f'SELECT time_stamp, device_id, {merged} FROM {parts} WHERE rollup = %s '
+                           f'AND (time_stamp, device_id) IN (SELECT time_stamp, device_id FROM rollup_stage) GROUP BY time_stamp, device_id '
+                           f'ON CONFLICT (time_stamp, device_id) DO UPDATE SET {updates}, first_time = EXCLUDED.first_time', (table_name,))
+            raw_connection.commit()
+
+        except Exception:
+            raw_connection.rollback()
+            raise
+
+        finally:
+            cursor.close()
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _provision_table(self, df, table_name: str) -> None:
+        """Creates the signal table together with its (time stamp, device) key and (device, time stamp) index
+        if it is not in the table cache"""
+        if table_name in self._tables:
+            self._migrate_device_key(table_name)
+            return
+
+        value_type = self._sql_type(df.dtypes.iloc[0])
+
+        if self._table_index == "brin":
+            self.querry(f'CREATE TABLE IF NOT EXISTS {self._schema_name}."{table_name}" (time_stamp TIMESTAMP WITH TIME ZONE NOT NULL, '
+                        f"""device_id TEXT NOT NULL DEFAULT '', "{table_name}" {value_type})""", False)
+            self.querry(f'CREATE INDEX IF NOT EXISTS "{table_name}_brin" ON {self._schema_name}."{table_name}" USING BRIN (time_stamp)', False)
+        else:
+            self.querry(f'CREATE TABLE IF NOT EXISTS {self._schema_name}."{table_name}" (time_stamp TIMESTAMP WITH TIME ZONE NOT NULL, '
+                        f"""device_id TEXT NOT NULL DEFAULT '', "{table_name}" {value_type}, PRIMARY KEY (time_stamp, device_id))""", False)
+            self._provision_device_index(table_name, "device_id, time_stamp")
+
+        self._tables.add(table_name)
+        self._device_tables.add(table_name)
+        self._keyed_tables.add(table_name)
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _migrate_device_key(self, table_name: str) -> None:
+        """Adds the device_id column to a table created before devices were stored and makes it part of the primary key.
+        Existing rows get an empty device id."""
+        if table_name in self._keyed_tables:
+            return
+
+        if table_name not in self._device_tables:
+            self._comm.send_to_print(f"       - adding device_id to table {table_name}")
+            self.querry(f"""ALTER TABLE {self._schema_name}."{table_name}" ADD COLUMN IF NOT EXISTS device_id TEXT NOT NULL DEFAULT ''""", False)
+            self._device_tables.add(table_name)
+
+        self._provision_keys(table_name, "time_stamp, device_id", "device_id, time_stamp")
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _provision_keys(self, table_name: str, key: str, device_index: str) -> None:
+        """Recreates the primary key of an existing table with given column order and adds the per-device index.
+        Keys starting with device_id (created by older versions) cannot serve queries filtering on time stamps only."""
+        if table_name in self._keyed_tables:
+            return
+
+        # tables with BRIN indexes have no key
+        primary_key = self.querry(f"""SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint """
+                                  f"""WHERE conrelid = '{self._schema_name}."{table_name}"'::regclass AND contype = 'p'""", True)
+        if primary_key is not None and len(primary_key) > 0 and primary_key[0][1] != f"PRIMARY KEY ({key})":
+            self._comm.send_to_print(f"       - reordering primary key of table {table_name}")
+            self.querry(f'ALTER TABLE {self._schema_name}."{table_name}" DROP CONSTRAINT "{primary_key[0][0]}", ADD PRIMARY KEY ({key})', False)
+
+        if primary_key is not None and len(primary_key) > 0:
+            self._provision_device_index(table_name, device_index)
+
+        self._keyed_tables.add(table_name)
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _provision_device_index(self, table_name: str, columns: str) -> None:
+        """Creates the index of per-device range queries next to the time-leading primary key unless the table has it"""
+        indexes = self.querry(f"SELECT indexdef FROM pg_indexes WHERE schemaname = '{self._schema_name}' AND tablename = '{table_name}'", True)
+        if indexes is None or any(row[0].endswith(f"({columns})") for row in indexes):
+            return
+
+        self.querry(f'CREATE INDEX ON {self._schema_name}."{table_name}" ({columns})', False)
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _sql_type(self, dtype) -> str:
+        """Returns the postgres column type matching the given pandas dtype (same types as to_sql uses)"""
+        if pd.api.types.is_bool_dtype(dtype):
+            return "BOOLEAN"
+
+        if pd.api.types.is_integer_dtype(dtype):
+            return "BIGINT"
+
+        if pd.api.types.is_float_dtype(dtype):
+            return "DOUBLE PRECISION"
+
+        return "TEXT"
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _copy_data(self, raw_connection, df, table_name: str, device_id: str) -> None:
+        """Streams one signal dataframe through COPY into a staging table and merges it into the signal table.
+        Rows with (device, time stamp) already present in the signal table are skipped, unless BRIN indexes are used."""
+
+        # encode the signal as CSV - time stamp first, then the device and the value
+        csv_buffer = io.StringIO()
+        df.assign(device_id=device_id if device_id is not None else "")[["device_id", table_name]].to_csv(csv_buffer, header=False, index=True)
+        csv_buffer.seek(0)
+
+        columns = f'time_stamp, device_id, "{table_name}"'
+        cursor = raw_connection.cursor()
+        try:
+            cursor.execute(f'CREATE TEMP TABLE signal_stage (LIKE {self._schema_name}."{table_name}" INCLUDING DEFAULTS) ON COMMIT DROP')
+            cursor.copy_expert(f"COPY signal_stage ({columns}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (device_id))", csv_buffer)
+            if self._table_index == "brin":
+                # no unique key to check against, all rows are appended
+                cursor.execute(f'INSERT INTO {self._schema_name}."{table_name}" ({columns}) SELECT {columns} FROM signal_stage')
+            else:
+                cursor.execute(f'INSERT INTO {self._schema_name}."{table_name}" ({columns}) SELECT {columns} FROM signal_stage ON CONFLICT (device_id, time_stamp) DO NOTHING')
+            inserted = cursor.rowcount
+            raw_connection.commit()
+
+        except Exception:
+            raw_connection.rollback()
+            raise
+
+        finally:
+            cursor.close()
+
+        if inserted < len(df):
+            self._comm.send_to_print(f"       - {len(df) - inserted} rows already in the DB were skipped.")
+
+        return
     
 # --------------------------------------------------------------------------------------------------------------------------------
 
     def finish(self) -> None:
-        """Function to handle database connection closing"""
+        """Function to handle database connection closing, the connection returns to the pool"""
+        if self._connection is None:
+            return
+
         try:
             self._comm.send_to_print("Closing database connection ...  ", end='')
             self._connection.close()
+            self._connection = None
             self._comm.send_to_print("done!")
             
         except Exception as e:
@@ -159,13 +749,17 @@ class DatabaseHandle:
             self._database = config["database"]["database"]
             self._user = config["database"]["user"]
             self._password = config["database"]["password"]
+            self._upload_mode = config["database"].get("upload_mode", "copy")
+            self._table_index = config["database"].get("table_index", "primary_key")
+            self._layout = config["database"].get("layout", "signal_tables")
+            self._pool_size = int(config["database"].get("pool_size", "5"))
             
             if config["settings"]["clean_upload"] == "true":
                 self._clean = True
             else:
                 self._clean = False
 
-            self._conn_string = "postgresql://" + self._user + ":" + self._password + "@" + self._host + "/" + self._database
+            self._conn_string = "postgresql://" + self._user + ":" + self._password + "@" + self._host + ":" + self._port + "/" + self._database
 
         except Exception as e:
             self._comm.send_error("WARNING", f"Problem with db config update:\n{e}", "F")
@@ -175,68 +769,214 @@ class DatabaseHandle:
 # --------------------------------------------------------------------------------------------------------------------------------
 
     def get_table_names(self) -> list:
+        """Returns names of signals stored in the database. Uses its own connection, so signals can be fetched during a conversion."""
         try:
-            inspector = inspect(self._engine)
-            tbl_names = inspector.get_table_names(schema=self._schema_name)
+            with self._get_engine().connect() as connection:
+                if self._layout == "long":
+                    rows = connection.execute(text(f"SELECT signal_name FROM {self._schema_name}.signal_dict ORDER BY signal_name")).fetchall()
+                    return [row[0] for row in rows]
+
+                if self._layout == "message_tables":
+                    return sorted(self._message_signals(connection))
+
+                # rollup tables are not signals
+                return [name for name in inspect(connection).get_table_names(schema=self._schema_name) if ROLLUP_SEPARATOR not in name]
 
         except Exception as e:
             self._comm.send_error("WARNING", f"Problem with signal fetching:\n{e}", "F")
             return None
-
-        return tbl_names
     
 # --------------------------------------------------------------------------------------------------------------------------------
 
-    def save_data(self, tables_str: str, from_time: str, to_time: str, file_path: str, file_type: str) -> None:
-        self._comm.send_to_print("Downloading data ...")
-        self.connect()
+    def _quote(self, name: str) -> str:
+        """Returns the name quoted as an SQL identifier, colons are escaped not to be taken for bind parameters"""
+        return '"' + name.replace('"', '""').replace(":", "\\:") + '"'
 
-        # get tabels to save
-        tables = tables_str.split(";")
-        # initialize output dataframe
-        combined_data_frame = pd.DataFrame(columns=["time_stamp"])
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _download_query(self, connection, tables: list, from_time: str, to_time: str) -> tuple:
+        """Returns a single query selecting given signals within the time range according to the storage layout,
+        its parameters and selected signals. Signal sources are joined by Postgres on time stamp and device,
+        the query returns time_stamp, device_id and signal columns ordered by time stamp and device."""
+        params = {"from_time": from_time, "to_time": to_time}
+        sources = []
+
+        if self._layout == "long":
+            for idx, tbl in enumerate(tables):
+                params[f"signal_{idx}"] = tbl
+                sources.append((f"SELECT time_stamp, device_id, value AS {self._quote(tbl)} FROM {self._schema_name}.signal_data "
+                                f"WHERE signal_id = (SELECT signal_id FROM {self._schema_name}.signal_dict WHERE signal_name = :signal_{idx}) "
+                                f"AND time_stamp >= :from_time AND time_stamp <= :to_time", [tbl]))
+
+        else:
+            # tables not uploaded since devices are stored have no device id
+            rows = connection.execute(text("SELECT table_name FROM information_schema.columns WHERE table_schema = :schema "
+                                           "AND column_name = 'device_id'"), {"schema": self._schema_name}).fetchall()
+            device_tables = set(row[0] for row in rows)
+
+            if self._layout == "message_tables":
+                # co-transmitted signals are read from their message table at once
+                message_signals = self._message_signals(connection)
+                messages = {}
+                for tbl in tables:
+                    messages.setdefault(message_signals.get(tbl, tbl), []).append(tbl)
+            else:
+                messages = {tbl: [tbl] for tbl in tables}
+
+            for table_name, signals in messages.items():
+                device = "device_id" if table_name in device_tables else "'' AS device_id"
+                columns = ", ".join(self._quote(signal) for signal in signals)
+                sources.append((f"SELECT time_stamp, {device}, {columns} FROM {self._schema_name}.{self._quote(table_name)} "
+                                f"WHERE time_stamp >= :from_time AND time_stamp <= :to_time", signals))
+
+        signals = [signal for _, source_signals in sources for signal in source_signals]
+        joined = " FULL OUTER JOIN ".join(f"({source}) AS s{idx}" + (" USING (time_stamp, device_id)" if idx > 0 else "")
+                                          for idx, (source, _) in enumerate(sources))
+        columns = ", ".join(self._quote(signal) for signal in signals)
+        qry = f'SELECT time_stamp, device_id, {columns} FROM {joined} ORDER BY time_stamp, device_id COLLATE "C"'
+
+        return qry, params, signals
 
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _stream_query(self, connection, qry: str, params: dict):
+        """Yields rows of the query. Rows are fetched through a server-side cursor in batches,
+        so the result is never held in memory whole."""
+        result = connection.execute(text(qry).execution_options(stream_results=True, yield_per=EXPORT_BATCH_ROWS), params)
         try:
-            for tbl in tables:
-                # fetch each table from the database
-                qry = f"SELECT * FROM {self._schema_name}.\"{tbl}\" WHERE time_stamp >= '{from_time}' AND time_stamp <= '{to_time}'"
+            for row in result:
+                yield list(row)
 
-                result = self.querry(qry, True)
-                # convert query result into a dataframe
-                data_frame = pd.DataFrame(result)
+        finally:
+            result.close()
 
-                if not data_frame.empty:
-                    # combine current signal dataframe with other downloading signals
-                    combined_data_frame = combined_data_frame.merge(data_frame, on="time_stamp", how="outer")
+# --------------------------------------------------------------------------------------------------------------------------------
 
-            self.finish()
+    def _arrow_schema(self, connection, qry: str, params: dict, header: list):
+        """Returns the arrow schema of the query result built from the column types reported by Postgres.
+        Columns of other types get None and are inferred from the first batch."""
+        result = connection.execute(text(f"SELECT * FROM ({qry}) AS result LIMIT 0"), params)
+        try:
+            return [(name, ARROW_TYPES.get(column[1])) for name, column in zip(header, result.cursor.description)]
 
-            # find out if dataframe is empty
-            if combined_data_frame.empty:
-                self._comm.send_error("WARNING", "Current selection doesn't conatin any data!", "F")
-                return
+        finally:
+            result.close()
 
-            # sort and save output dataframe
-            combined_data_frame.sort_values(by="time_stamp", inplace=True)
+# --------------------------------------------------------------------------------------------------------------------------------
 
-            self._comm.send_to_print("Saving ...")
+    def _write_columnar(self, rows, fields: list, file_path: str, file_type: str) -> int:
+        """Writes rows into a Parquet or Arrow IPC (Feather) file, one row group / record batch per cursor batch.
+        Returns the number of written rows or None when aborted. Fields are (name, arrow type) pairs, fields without
+        type are inferred from the first batch (floats if it has no values), as the schema can't change later."""
+        writer = None
+        schema = None
+        num_of_rows = 0
 
-            if file_type == "csv":
-                combined_data_frame.to_csv(file_path, index=False)
-            
-            if file_type == "xlsx":
-                # check excel sheet limitations
-                if len(combined_data_frame) > 1048576:
-                    self._comm.send_error("WARNING", f"Excel supports max 1 048 576 rows!\nYou tried to save {len(combined_data_frame)} rows.", "F")
+        try:
+            while True:
+                batch = list(itertools.islice(rows, EXPORT_BATCH_ROWS))
+                if len(batch) == 0:
+                    break
+
+                columns = [pa.array(column, type=field_type) for column, (_, field_type) in zip(zip(*batch), fields)]
+
+                if writer is None:
+                    schema = pa.schema([(name, pa.float64() if pa.types.is_null(column.type) else column.type) for (name, _), column in zip(fields, columns)])
+
+                    if file_type == "parquet":
+                        # device ids repeat a lot, time stamps grow steadily
+                        writer = pq.ParquetWriter(file_path, schema, compression="zstd", use_dictionary=["device_id"],
+                                                  column_encoding={"time_stamp": "DELTA_BINARY_PACKED"})
+                    else:
+                        writer = pa.ipc.new_file(file_path, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+
+                record_batch = pa.RecordBatch.from_arrays([column.cast(field.type) for column, field in zip(columns, schema)], schema=schema)
+                if file_type == "parquet":
+                    writer.write_batch(record_batch, row_group_size=EXPORT_BATCH_ROWS)
+                else:
+                    writer.write_batch(record_batch)
+                num_of_rows += len(batch)
+
+                # thread end check
+                if self._stop_event.is_set():
+                    print("Data download aborted.")
+                    return None
+
+        finally:
+            if writer is not None:
+                writer.close()
+
+        return num_of_rows
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def save_data(self, tables_str: str, from_time: str, to_time: str, file_path: str, file_type: str) -> None:
+        """Downloads given signals within the time range into a CSV, XLSX, Parquet or Feather file. Signals are
+        read by a single query streamed from the database, CSV and columnar files are written in constant memory."""
+        self._comm.send_to_print("Downloading data ...")
+
+        # get tabels to save
+        tables = tables_str.split(";")
+        temp_path = f"{file_path}.part"
+
+        try:
+            # own connection, a download may run during a conversion
+            with self._get_engine().connect() as connection:
+                qry, params, signals = self._download_query(connection, tables, from_time, to_time)
+                header = ["time_stamp", "device_id"] + signals
+                rows = self._stream_query(connection, qry, params)
+                num_of_rows = 0
+
+                if file_type == "csv":
+                    # write into a temporary file, nothing is left behind if the selection is empty
+                    with open(temp_path, "w", newline="") as file:
+                        writer = csv.writer(file)
+                        writer.writerow(header)
+                        for row in rows:
+                            writer.writerow(row)
+                            num_of_rows += 1
+
+                            # thread end check
+                            if num_of_rows % EXPORT_BATCH_ROWS == 0 and self._stop_event.is_set():
+                                print("Data download aborted.")
+                                return
+
+                if file_type in COLUMNAR_FORMATS:
+                    num_of_rows = self._write_columnar(rows, self._arrow_schema(connection, qry, params, header), temp_path, file_type)
+                    if num_of_rows is None:
+                        return
+
+                if file_type == "xlsx":
+                    # check excel sheet limitations
+                    excel_rows = list(itertools.islice(rows, EXCEL_MAX_ROWS + 1))
+                    num_of_rows = len(excel_rows)
+                    if num_of_rows > EXCEL_MAX_ROWS:
+                        self._comm.send_error("WARNING", "Excel supports max 1 048 576 rows!\nYou tried to save more rows.", "F")
+                        return
+
+                # find out if the selection is empty
+                if num_of_rows == 0:
+                    self._comm.send_error("WARNING", "Current selection doesn't conatin any data!", "F")
                     return
 
-                combined_data_frame["time_stamp"] = combined_data_frame["time_stamp"].dt.tz_localize(None)
-                combined_data_frame.to_excel(file_path, index=False)
+                self._comm.send_to_print("Saving ...")
 
-            self._comm.send_to_print(f"\nSUCCESS: {len(combined_data_frame)} rows of data saved to {file_path}")
+                if file_type == "csv" or file_type in COLUMNAR_FORMATS:
+                    os.replace(temp_path, file_path)
+
+                if file_type == "xlsx":
+                    data_frame = pd.DataFrame(excel_rows, columns=header)
+                    data_frame["time_stamp"] = pd.to_datetime(data_frame["time_stamp"], utc=True).dt.tz_localize(None)
+                    data_frame.to_excel(file_path, index=False)
+
+                self._comm.send_to_print(f"\nSUCCESS: {num_of_rows} rows of data saved to {file_path}")
 
         except Exception as e:
             self._comm.send_error("WARNING", f"Problem with data download:\n{e}", "F")
             return
 
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
         return
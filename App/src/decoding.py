@@ -0,0 +1,535 @@
+# Made by Ondrej Luks, 2023
+# ondrej.luks@doosan.com
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+from .mfd import MultiFrameDecoder
+from .proc_data import ProcessData
+
+from pathlib import Path
+import copy
+import fnmatch
+import hashlib
+import os
+import pickle
+import re
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import can_decoder
+import canedge_browser
+import mdf_iter
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+# DBC databases of a worker process, loaded once by init_decode_worker
+_worker_dbc_list = None
+# decoded file cache of a worker process - (folder, DBC set key, size limit in bytes)
+_worker_decoded_cache = ("", "", 0)
+
+# default folder of the parsed DBC cache
+DBC_CACHE_PATH = os.path.join(Path(__file__).parent, "dbc_cache")
+
+# default folder of the decoded file cache
+DECODED_CACHE_PATH = os.path.join(Path(__file__).parent, "decoded_cache")
+# transport protocol and format of decoded files, a change makes all cached files outdated
+DECODED_CACHE_VERSION = "j1939-1"
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def setup_fs() -> canedge_browser.LocalFileSystem:
+    """Sets up a filesystem required for signal extraxtion from raw MF4"""
+    base_path = Path(__file__).parent
+    return canedge_browser.LocalFileSystem(base_path=base_path)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def prefilter_frames(df_raw: pd.DataFrame, dbc_list: list) -> tuple:
+    """Drops raw frames which no DBC database can decode. J1939 databases match extended frames by PGN,
+    the other ones match by CAN ID and IDE. Returns the filtered dataframe, number of skipped frames and bytes."""
+    if df_raw.shape[0] == 0:
+        return df_raw, 0, 0
+
+    tp = MultiFrameDecoder("j1939")
+    can_ids = df_raw["ID"].to_numpy(dtype=np.int64)
+    extended = df_raw["IDE"].to_numpy(dtype=bool)
+    fused_ids = np.where(extended, can_ids | 0x80000000, can_ids)
+
+    j1939_pgns = set()
+    fused_frame_ids = set()
+    for db in dbc_list:
+        if db.protocol == "J1939":
+            j1939_pgns.update(tp.calculate_pgn(frame_id) for frame_id in db.frames)
+        else:
+            fused_frame_ids.update(db.frames)
+
+    keep = np.isin(fused_ids, list(fused_frame_ids))
+    if len(j1939_pgns) > 0:
+        keep |= extended & np.isin(tp.calculate_pgns(can_ids), list(j1939_pgns))
+
+    skipped = ~keep
+    skipped_frames = int(skipped.sum())
+    skipped_bytes = int(df_raw["DataLength"].to_numpy()[skipped].sum())
+    if skipped_frames == 0:
+        return df_raw, 0, 0
+
+    return df_raw[keep], skipped_frames, skipped_bytes
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def decode_raw(df_raw: pd.DataFrame, dbc_list: list, proc: ProcessData) -> tuple:
+    """Decodes raw dataframe with combined TP frames to a dataframe of physical values.
+    Returns the dataframe with number of skipped undecodable frames and bytes."""
+    # drop frames no DBC file can decode
+    df_raw, skipped_frames, skipped_bytes = prefilter_frames(df_raw, dbc_list)
+
+    # extract can messages
+    df_phys = proc.extract_phys(df_raw)
+
+    # set correct index values
+    df_phys.index = pd.to_datetime(df_phys.index)
+    df_phys.index = df_phys.index.round('1us')
+
+    return df_phys, skipped_frames, skipped_bytes
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def decode_mf4(mf4_file: str, dbc_list: list, stop_event=None) -> tuple:
+    """Reads MF4 file and decodes it to a dataframe of physical values. Returns the dataframe with number
+    of skipped undecodable frames and bytes and the device ID, or None if stop_event is set meanwhile."""
+    fs = setup_fs()
+    proc = ProcessData(fs, dbc_list)
+
+    # get raw dataframe from mf4 file
+    df_raw, device_id = proc.get_raw_data(mf4_file)
+
+    # thread end check
+    if stop_event is not None and stop_event.is_set():
+        return None
+
+    # replace transport protocol with single frames
+    tp = MultiFrameDecoder("j1939")
+    df_raw = tp.combine_tp_frames(df_raw)
+
+    # thread end check
+    if stop_event is not None and stop_event.is_set():
+        return None
+
+    return decode_raw(df_raw, dbc_list, proc) + (device_id,)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def _records_to_raw_df(records: list) -> pd.DataFrame:
+    """Converts CAN data frame records of the mdf_iter iterator to a raw dataframe with the columns used by
+    get_data_frame. Record ID is the generic ID with the extended flag in the most significant bit.
+    Records must carry their bus channel, see read_raw_chunks."""
+    generic_ids = np.fromiter((record.id for record in records), dtype=np.int64, count=len(records))
+    time_stamps = np.fromiter((record.timestamp for record in records), dtype=np.float64, count=len(records))
+    data_bytes = [list(record.data) for record in records]
+    lengths = np.fromiter(map(len, data_bytes), dtype=np.uint8, count=len(records))
+
+    index = pd.to_datetime(np.round(time_stamps * 1e9).astype(np.int64), utc=True)
+    index.name = "TimeStamp"
+
+    return pd.DataFrame({"BusChannel": np.fromiter((record.bus_channel for record in records), dtype=np.uint8, count=len(records)),
+                         "ID": (generic_ids & 0x1FFFFFFF).astype(np.uint32),
+                         "IDE": ((generic_ids >> 31) & 1).astype(np.uint8),
+                         "DLC": lengths,
+                         "DataLength": lengths,
+                         "DataBytes": data_bytes}, index=index)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def read_raw_chunks(mf4_file: str, chunk_rows: int, proc: ProcessData):
+    """Generator of raw dataframes with at most chunk_rows CAN frames, read from MF4 file by the mdf_iter iterator.
+    Yields the dataframes with the device ID. Iterator records of mdf_iter versions which don't expose the bus
+    channel (including the current one) can't tell CAN buses apart, such files are read whole by get_data_frame
+    and split into chunks - the raw frames of the whole file are then held in memory until the last chunk."""
+    with proc.fs.open(mf4_file, "rb") as handle:
+        mdf_file = mdf_iter.MdfFile(handle)
+        device_id = proc.get_device_id(mdf_file)
+        iterator = mdf_file.get_iterator(mdf_iter.MessageTypes.CAN_DataFrame)
+        first_record = next(iterator, None)
+
+        if first_record is not None and hasattr(first_record, "bus_channel"):
+            records = [first_record]
+            for record in iterator:
+                records.append(record)
+                if len(records) >= chunk_rows:
+                    yield _records_to_raw_df(records), device_id
+                    records = []
+
+            if len(records) > 0:
+                yield _records_to_raw_df(records), device_id
+
+            return
+
+    if first_record is None:
+        return
+
+    # unknown bus channel, fall back to reading the whole file
+    df_raw, device_id = proc.get_raw_data(mf4_file)
+    for start in range(0, df_raw.shape[0], chunk_rows):
+        yield df_raw.iloc[start:start + chunk_rows], device_id
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def decode_mf4_chunks(mf4_file: str, dbc_list: list, chunk_rows: int, stop_event=None):
+    """Generator of decode_raw results with the device ID of MF4 file read in chunks of chunk_rows frames.
+    TP sequences which are not complete at the end of a chunk continue in the next one. Stops if stop_event is set."""
+    proc = ProcessData(setup_fs(), dbc_list)
+    tp = MultiFrameDecoder("j1939")
+    df_open = None
+    device_id = None
+
+    for df_raw, device_id in read_raw_chunks(mf4_file, chunk_rows, proc):
+        # thread end check
+        if stop_event is not None and stop_event.is_set():
+            return
+
+        if df_open is not None and df_open.shape[0] > 0:
+            df_raw = pd.concat([df_open, df_raw])
+
+        # replace transport protocol with single frames, open TP sequences wait for the next chunk
+        df_raw, df_open = tp.split_open_segments(df_raw)
+        yield decode_raw(tp.combine_tp_frames(df_raw), dbc_list, proc) + (device_id,)
+
+    # TP sequences open at the end of the file are incomplete, only their single frames are left
+    if df_open is not None and df_open.shape[0] > 0:
+        yield decode_raw(tp.combine_tp_frames(df_open), dbc_list, proc) + (device_id,)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def load_dbc(dbc_path: str, cache_path: str = DBC_CACHE_PATH) -> can_decoder.SignalDB:
+    """Loads DBC file via can_decoder. Parsed databases are pickled into cache_path, keyed by the file path,
+    size, modification time and content hash, so unchanged DBC files are not parsed again."""
+    if not cache_path:
+        return can_decoder.load_dbc(dbc_path)
+
+    dbc_path = os.path.abspath(dbc_path)
+    stat = os.stat(dbc_path)
+    with open(dbc_path, "rb") as file:
+        content_hash = hashlib.sha256(file.read()).hexdigest()
+
+    key = (dbc_path, stat.st_size, stat.st_mtime_ns, content_hash)
+    cache_file = os.path.join(cache_path, hashlib.sha1(dbc_path.encode()).hexdigest() + ".pkl")
+
+    # use the cached database if it belongs to the same file content
+    try:
+        with open(cache_file, "rb") as file:
+            cached_key, db = pickle.load(file)
+        if cached_key == key:
+            return db
+
+    except Exception:
+        # missing, outdated or broken cache file
+        pass
+
+    db = can_decoder.load_dbc(dbc_path)
+
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        # write into a temporary file first, so other processes never read a half-written cache
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(temp_file, "wb") as file:
+            pickle.dump((key, db), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, cache_file)
+
+    except Exception as e:
+        print(f"Can't write DBC cache: {e}")
+
+    return db
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def load_message_names(dbc_path: str) -> dict:
+    """Returns names of messages defined in DBC file by frame id as written in the file (the same id as
+    can_decoder uses). can_decoder keeps only frame ids, so the names are read from BO_ lines of the file."""
+    names = {}
+    with open(dbc_path, "r", errors="ignore") as file:
+        for line in file:
+            match = re.match(r"\s*BO_\s+(\d+)\s+(\w+)\s*:", line)
+            if match is not None:
+                names.setdefault(int(match.group(1)), match.group(2))
+
+    return names
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def signal_messages(db_list: list, message_names: dict) -> dict:
+    """Returns the name of the message every signal of given databases comes from. Frames without
+    a known name are called msg_<frame id in hex>."""
+    messages = {}
+    for db in db_list:
+        for frame in db.frames.values():
+            message = message_names.get(frame.id, f"msg_{frame.id:X}")
+            for name in _signal_names(frame.signals):
+                messages.setdefault(name, message)
+
+    return messages
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def _signal_names(signals: list) -> set:
+    """Returns names of given signals including all multiplexed signals"""
+    names = set()
+    for signal in signals:
+        names.add(signal.name)
+        if signal.is_multiplexer:
+            for multiplex in signal.signals.values():
+                names |= _signal_names(multiplex)
+
+    return names
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def merge_signal_dbs(db_list: list) -> list:
+    """Merges loaded DBC databases into one database per protocol, so every frame is decoded only once.
+    If a frame or a signal is defined in more DBC files, the definition from the first DBC file wins."""
+    tp = MultiFrameDecoder("j1939")
+    merged_dbs = {}
+    merged_frames = {}
+
+    for db in db_list:
+        if db.protocol not in merged_dbs:
+            merged_dbs[db.protocol] = can_decoder.SignalDB(db.protocol)
+            merged_frames[db.protocol] = {}
+
+        # J1939 frames are looked up by PGN, so frames with the same PGN are the same message
+        db_frames = {}
+        for frame_id, frame in db.frames.items():
+            db_frames[tp.calculate_pgn(frame_id) if db.protocol == "J1939" else frame_id] = frame
+
+        frames = merged_frames[db.protocol]
+        for frame_key, frame in db_frames.items():
+            if frame_key not in frames:
+                # copy the frame, loaded databases stay untouched
+                frames[frame_key] = can_decoder.Frame(frame.id, frame.size)
+                merged_dbs[db.protocol].add_frame(frames[frame_key])
+
+            merged_frame = frames[frame_key]
+            known_names = _signal_names(merged_frame.signals)
+            for signal in frame.signals:
+                if len(_signal_names([signal]) & known_names) > 0:
+                    continue
+                if signal.is_multiplexer and merged_frame.multiplexer is not None:
+                    continue
+
+                merged_frame.add_signal(signal)
+                known_names |= _signal_names([signal])
+
+    return list(merged_dbs.values())
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def _filter_signal(signal: can_decoder.Signal, patterns: list) -> can_decoder.Signal:
+    """Returns the signal if its name matches any of the patterns, None otherwise. Multiplexers are kept
+    (as pruned copies) if any of their multiplexed signals match."""
+    if not signal.is_multiplexer:
+        if any(fnmatch.fnmatchcase(signal.name, pattern) for pattern in patterns):
+            return signal
+        return None
+
+    multiplexed = {}
+    for mux_value, mux_signals in signal.signals.items():
+        kept = [kept_signal for kept_signal in (_filter_signal(sub_signal, patterns) for sub_signal in mux_signals) if kept_signal is not None]
+        if len(kept) > 0:
+            multiplexed[mux_value] = kept
+
+    if len(multiplexed) == 0:
+        return None
+
+    pruned = copy.copy(signal)
+    pruned.signals = multiplexed
+    return pruned
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def filter_signal_dbs(db_list: list, patterns: list) -> list:
+    """Prunes databases to frames and signals matching given signal names or glob patterns,
+    so only wanted messages are decoded. Empty list of patterns keeps all signals."""
+    if len(patterns) == 0:
+        return db_list
+
+    filtered_dbs = []
+    for db in db_list:
+        filtered_db = can_decoder.SignalDB(db.protocol)
+        for frame in db.frames.values():
+            kept = [kept_signal for kept_signal in (_filter_signal(signal, patterns) for signal in frame.signals) if kept_signal is not None]
+            if len(kept) == 0:
+                continue
+
+            filtered_frame = can_decoder.Frame(frame.id, frame.size)
+            for signal in kept:
+                filtered_frame.add_signal(signal)
+            filtered_db.add_frame(filtered_frame)
+
+        if len(filtered_db.frames) > 0:
+            filtered_dbs.append(filtered_db)
+
+    return filtered_dbs
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def init_decode_worker(dbc_paths: list, cache_path: str = DBC_CACHE_PATH, patterns: list = [], decoded_cache: tuple = ("", "", 0)) -> None:
+    """Pool initializer. Loads DBC files once per worker process."""
+    global _worker_dbc_list, _worker_decoded_cache
+    _worker_dbc_list = filter_signal_dbs(merge_signal_dbs([load_dbc(path, cache_path) for path in dbc_paths]), patterns)
+    _worker_decoded_cache = decoded_cache
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def decode_mf4_worker(mf4_file: str) -> tuple:
+    """Worker entry point. Decodes one MF4 file using DBC files loaded by init_decode_worker."""
+    cache_path, dbc_key, max_bytes = _worker_decoded_cache
+    return decode_mf4_cached(mf4_file, _worker_dbc_list, cache_path, dbc_key, max_bytes)
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+def _file_hash(path: str) -> str:
+    """Returns SHA-256 of the file content"""
+    content_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            content_hash.update(block)
+
+    return content_hash.hexdigest()
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def dbc_set_key(dbc_paths: list, patterns: list) -> str:
+    """Returns a key of everything that decides how MF4 files are decoded - content of DBC files,
+    the signal allow-list and the transport protocol"""
+    key = hashlib.sha256(DECODED_CACHE_VERSION.encode())
+    for content_hash in sorted(_file_hash(path) for path in dbc_paths):
+        key.update(content_hash.encode())
+    key.update(json.dumps(sorted(patterns)).encode())
+    return key.hexdigest()
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def load_decoded(cache_file: str) -> tuple:
+    """Returns decode_mf4 result stored in the cache file, None if the file is missing or broken.
+    The file is marked as recently used."""
+    try:
+        table = pq.read_table(cache_file)
+        info = json.loads(table.schema.metadata[b"decoded_info"])
+        os.utime(cache_file)
+
+    except Exception:
+        return None
+
+    return table.to_pandas(), info["skipped_frames"], info["skipped_bytes"], info["device_id"]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def store_decoded(cache_file: str, decoded: tuple, max_bytes: int) -> None:
+    """Stores decode_mf4 result into the cache file as Parquet and evicts least recently used files
+    above max_bytes"""
+    df_phys, skipped_frames, skipped_bytes, device_id = decoded
+
+    try:
+        table = pa.Table.from_pandas(df_phys)
+        info = json.dumps({"skipped_frames": int(skipped_frames), "skipped_bytes": int(skipped_bytes), "device_id": device_id})
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"decoded_info": info.encode()})
+
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # write into a temporary file first, so other processes never read a half-written cache
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        pq.write_table(table, temp_file, compression="zstd")
+        os.replace(temp_file, cache_file)
+
+    except Exception as e:
+        print(f"Can't write decoded file cache: {e}")
+        return
+
+    evict_decoded(os.path.dirname(cache_file), max_bytes)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def evict_decoded(cache_path: str, max_bytes: int) -> int:
+    """Deletes least recently used files of the decoded file cache until it fits into max_bytes.
+    Returns the number of deleted bytes."""
+    entries = []
+    for entry in os.scandir(cache_path):
+        try:
+            if entry.name.endswith(".parquet"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        except OSError:
+            # deleted by another process meanwhile
+            pass
+
+    total = sum(size for _, size, _ in entries)
+    deleted = 0
+    for _, size, path in sorted(entries):
+        if total - deleted <= max_bytes:
+            break
+
+        try:
+            os.remove(path)
+            deleted += size
+
+        except OSError:
+            pass
+
+    return deleted
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def purge_decoded_cache(cache_path: str = DECODED_CACHE_PATH) -> int:
+    """Deletes all files of the decoded file cache. Returns the number of deleted bytes."""
+    if not os.path.isdir(cache_path):
+        return 0
+
+    return evict_decoded(cache_path, 0)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def decode_mf4_cached(mf4_file: str, dbc_list: list, cache_path: str, dbc_key: str, max_bytes: int, stop_event=None) -> tuple:
+    """decode_mf4 with the decoded file cache. Cached files are keyed by the MF4 content hash and the DBC set key,
+    so a file decoded before with the same DBC files is read from the cache. Empty cache_path disables the cache."""
+    if not cache_path:
+        return decode_mf4(mf4_file, dbc_list, stop_event)
+
+    cache_file = os.path.join(cache_path, hashlib.sha256((_file_hash(mf4_file) + dbc_key).encode()).hexdigest() + ".parquet")
+    decoded = load_decoded(cache_file)
+    if decoded is not None:
+        return decoded
+
+    decoded = decode_mf4(mf4_file, dbc_list, stop_event)
+    if decoded is not None:
+        store_decoded(cache_file, decoded, max_bytes)
+
+    return decoded
@@ -710,6 +710,14 @@ class DownloadFrame(customtkinter.CTkFrame):
             self._btn_download_xlsx = customtkinter.CTkButton(self, text="Download as Excel", text_color=self.master.col_btn_tx, text_color_disabled=self.master.col_btn_dis_tx, command=lambda: self._btn_callback_download("xlsx"), width=200)
             self._btn_download_xlsx.grid(row=6, column=1, padx=0, pady=(10, 0), sticky="sw")
 
+            # Parquet download button
+            self._btn_download_parquet = customtkinter.CTkButton(self, text="Download as Parquet", text_color=self.master.col_btn_tx, text_color_disabled=self.master.col_btn_dis_tx, command=lambda: self._btn_callback_download("parquet"), width=200)
+            self._btn_download_parquet.grid(row=7, column=0, padx=(0, 20), pady=(10, 0), sticky="se")
+
+            # Feather download button
+            self._btn_download_feather = customtkinter.CTkButton(self, text="Download as Feather", text_color=self.master.col_btn_tx, text_color_disabled=self.master.col_btn_dis_tx, command=lambda: self._btn_callback_download("feather"), width=200)
+            self._btn_download_feather.grid(row=7, column=1, padx=0, pady=(10, 0), sticky="sw")
+
         except Exception as e:
             self.master.error_handle("ERROR", f"Unable to create GUI - download:\n{e}", terminate=True)
 
@@ -788,12 +796,21 @@ class DownloadFrame(customtkinter.CTkFrame):
 
             elif file_type == "xlsx":
                 file_path = filedialog.asksaveasfile(defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx")])
+
+            elif file_type == "parquet":
+                file_path = filedialog.asksaveasfile(defaultextension=".parquet", filetypes=[("Parquet files", "*.parquet")])
+
+            elif file_type == "feather":
+                file_path = filedialog.asksaveasfile(defaultextension=".feather", filetypes=[("Feather files", "*.feather")])
             
             else:
                 file_path = None
             
             # file path was provided
             if file_path:
+                # the backend replaces the file once complete, so it must not be held open
+                file_path.close()
+
                 # merge signals into semicolumn-separated string
                 signals_str = ""
                 for idx, sig in enumerate(self._selected_signals):
@@ -990,6 +1007,11 @@ class ConversionFrame(customtkinter.CTkFrame):
             # convert button
             self._btn_start_conv = customtkinter.CTkButton(self, text="Start conversion & upload", text_color=self.master.col_btn_tx, text_color_disabled=self.master.col_btn_dis_tx, command=self._btn_callback_start, width=200)
             self._btn_start_conv.grid(row=5, column=0, columnspan=2, padx=10, pady=(10, 0), sticky="s")
+
+            if self.master.admin_mode:
+                # purge cache button
+                self._btn_purge_cache = customtkinter.CTkButton(self, text="Purge decoded file cache", text_color=self.master.col_btn_tx, text_color_disabled=self.master.col_btn_dis_tx, command=self._btn_callback_purge, width=200)
+                self._btn_purge_cache.grid(row=6, column=0, columnspan=2, padx=10, pady=(10, 0), sticky="s")
         
         except Exception as e:
             self.master.error_handle("ERROR", f"Unable to create GUI - process\n{e}", terminate=True)
@@ -1000,16 +1022,26 @@ class ConversionFrame(customtkinter.CTkFrame):
         self.master.comm.send_command("RUN-PROP")
         return
 
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _btn_callback_purge(self) -> None:
+        self.master.comm.send_command("PURGE-CACHE")
+        return
+
 # --------------------------------------------------------------------------------------------------------------------------------
     
     def disable_start_btn(self) -> None:
         self._btn_start_conv.configure(state="disabled")
+        if self.master.admin_mode:
+            self._btn_purge_cache.configure(state="disabled")
         return
 
 # --------------------------------------------------------------------------------------------------------------------------------
     
     def enable_start_btn(self) -> None:
         self._btn_start_conv.configure(state="normal")
+        if self.master.admin_mode:
+            self._btn_purge_cache.configure(state="normal")
         return
 
 # --------------------------------------------------------------------------------------------------------------------------------
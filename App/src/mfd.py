@@ -70,29 +70,29 @@ class MultiFrameDecoder:
             pgn &= 0xFFFFFF00
         return pgn
 
+    def calculate_pgns(self, frame_ids):
+        # vectorized calculate_pgn for an array of CAN IDs
+        import numpy as np
+
+        pgns = (np.asarray(frame_ids, dtype=np.int64) & 0x03FFFF00) >> 8
+        return np.where((pgns & 0xFF00) < 0xF000, pgns & 0xFFFFFF00, pgns)
+
     def calculate_sa(self, frame_id):
         sa = frame_id & 0x000000FF
         return sa
 
-    def construct_new_tp_frame(self, base_frame, payload_concatenated, can_id):
-        new_frame = base_frame.copy()
-        new_frame["DataBytes"] = payload_concatenated
-        new_frame["DLC"] = 0
-        new_frame["DataLength"] = len(payload_concatenated)
-        if can_id:
-            new_frame["ID"] = can_id
-        return new_frame
-
     def identify_matching_ids(self,df_raw,res_id_list_full, bam_pgn):
         # identify which CAN IDs (or PGNs) match the TP IDs and create a filtered df_raw_match
         # which is used to separate the df_raw into two parts: Incl/excl TP frames.
         # Also produces a reduced res_id_list that only contains relevant ID entries
+        import pandas as pd
+
         if self.tp_type == "nmea":
-            df_raw_pgns = df_raw["ID"].apply(self.calculate_pgn)
+            df_raw_pgns = pd.Series(self.calculate_pgns(df_raw["ID"].to_numpy()), index=df_raw.index)
             df_raw_match = df_raw_pgns.isin(res_id_list_full)
             res_id_list = df_raw_pgns[df_raw_match].drop_duplicates().values.tolist()
         if self.tp_type == "j1939":
-            df_raw_pgns = df_raw["ID"].apply(self.calculate_pgn)
+            df_raw_pgns = pd.Series(self.calculate_pgns(df_raw["ID"].to_numpy()), index=df_raw.index)
             df_raw_match = df_raw_pgns.isin(res_id_list_full)
             res_id_list = res_id_list_full.copy() 
             res_id_list.remove(bam_pgn)
@@ -111,44 +111,132 @@ class MultiFrameDecoder:
 
         return df_raw_tp,  df_raw_excl_tp, res_id_list, df_raw_pgns
 
-    def filter_df_raw_tp(self, df_raw_tp, df_raw_tp_pgns,res_id):
-        # filter df_raw_tp to include only frames for the specific response ID res_id
-        if self.tp_type == "nmea":
-            df_raw_tp_res_id = df_raw_tp[df_raw_tp_pgns.isin([res_id])]
-        elif self.tp_type == "j1939":
-            df_raw_tp_res_id = df_raw_tp
-            df_raw_tp_res_id = df_raw_tp_res_id.copy()
-            df_raw_tp_res_id["SA"] = df_raw_tp_res_id["ID"].apply(self.calculate_sa)
-        else:
-            df_raw_tp_res_id = df_raw_tp[df_raw_tp["ID"].isin([res_id])]
-        return df_raw_tp_res_id
-
-    def check_if_first_frame(self,row, bam_pgn, first_frame_mask,first_frame):
-        # check if row reflects the first frame of a TP sequence
-        if self.tp_type == "j1939" and bam_pgn == self.calculate_pgn(row.ID):
-            first_frame_test = True
-        elif (row.DataBytes[0] & first_frame_mask) == first_frame:
-            first_frame_test = True
+    def group_tp_frames(self, df_raw_tp, res_id_list):
+        # order TP frames the way they are processed: by response ID, then by BusChannel and then
+        # by ID (or SA for J1939), keeping the time order within each group. Returns the row order
+        # and a mask of rows that start a new group
+        import numpy as np
+
+        ids = df_raw_tp["ID"].to_numpy(dtype=np.int64)
+        channels = df_raw_tp["BusChannel"].to_numpy()
+
+        if self.tp_type == "j1939":
+            # all J1939 TP frames are handled as one response ID, grouped by source address
+            res_rank = np.zeros(len(ids), dtype=np.int64)
+            identifiers = ids & 0x000000FF
         else:
-            first_frame_test = False
+            # response IDs are processed in the order of res_id_list
+            res_keys = self.calculate_pgns(ids) if self.tp_type == "nmea" else ids
+            rank_of = {res_id: rank for rank, res_id in enumerate(res_id_list)}
+            unique_keys, key_idx = np.unique(res_keys, return_inverse=True)
+            res_rank = np.array([rank_of[key] for key in unique_keys.tolist()], dtype=np.int64)[key_idx]
+            identifiers = ids
+
+        order = np.lexsort((identifiers, channels, res_rank))
+        res_rank, channels, identifiers = res_rank[order], channels[order], identifiers[order]
 
-        return first_frame_test
+        group_start = np.ones(len(order), dtype=bool)
+        group_start[1:] = (res_rank[1:] != res_rank[:-1]) | (channels[1:] != channels[:-1]) | (identifiers[1:] != identifiers[:-1])
 
-    def pgn_to_can_id(self,row):
-        # for J1939, extract PGN and convert to 29 bit CAN ID for use in baseframe
-        pgn_hex = "".join("{:02x}".format(x) for x in reversed(row.DataBytes[5:8]))
-        pgn = int(pgn_hex, 16)
-        can_id = (6 << 26) | (pgn << 8) | row.SA
-        return can_id
+        return order, group_start
 
-    def get_payload_length(self,row):
+    def get_payload_lengths(self, byte_0, byte_1):
+        # expected payload length of each first frame
         if self.tp_type == "uds":
-            ff_length = (row.DataBytes[0] & 0x0F) << 8 | row.DataBytes[1]
-        if self.tp_type == "nmea":
-            ff_length = row.DataBytes[1]
+            return (byte_0 & 0x0F) << 8 | byte_1
+        return byte_1
+
+    def pgns_to_can_ids(self, byte_5, byte_6, byte_7, sa):
+        # for J1939, extract the PGN of the transported message from a BAM frame and convert it
+        # to a 29 bit CAN ID
+        pgn = byte_5 | (byte_6 << 8) | (byte_7 << 16)
+        return (6 << 26) | (pgn << 8) | sa
+
+    def accept_conseq_frames(self, conseq_seq, conseq_seg):
+        # a consequtive frame is accepted into the payload if it is the first one after the first frame,
+        # or if its sequence number follows the last accepted one. Segments with gaps or repeated
+        # frames are resolved frame by frame, the rest is accepted at once
+        import numpy as np
+
+        accepted = np.ones(len(conseq_seq), dtype=bool)
+        same_seg = conseq_seg[1:] == conseq_seg[:-1]
+        broken = same_seg & (np.diff(conseq_seq) != 1)
+
+        # frames are ordered by segment, so each broken segment is a contiguous range
+        broken_segs = np.unique(conseq_seg[1:][broken])
+        seg_begin = np.searchsorted(conseq_seg, broken_segs, side="left")
+        seg_end = np.searchsorted(conseq_seg, broken_segs, side="right")
+        conseq_seq = conseq_seq.tolist()
+
+        for begin, end in zip(seg_begin.tolist(), seg_end.tolist()):
+            conseq_frame_prev = None
+            for pos in range(begin, end):
+                if (conseq_frame_prev == None) or ((conseq_seq[pos] - conseq_frame_prev) == 1):
+                    conseq_frame_prev = conseq_seq[pos]
+                else:
+                    accepted[pos] = False
+
+        return accepted
+
+    def classify_tp_frames(self, ids, byte_0, bam_pgn, first_frame_mask, first_frame, single_frame_mask, single_frame):
+        # masks of single frames and first frames, the rest are consequtive frames
+        import numpy as np
+
+        if self.tp_type != "nmea":
+            is_single = (byte_0 & single_frame_mask) == single_frame
+        else:
+            is_single = np.zeros(len(ids), dtype=bool)
+
+        is_first = (byte_0 & first_frame_mask) == first_frame
         if self.tp_type == "j1939":
-            ff_length = int("".join("{:02x}".format(x) for x in reversed(row.DataBytes[1:2])),16)
-        return ff_length
+            is_first |= self.calculate_pgns(ids) == bam_pgn
+        is_first &= ~is_single
+
+        return is_single, is_first
+
+    def split_open_segments(self, df_raw):
+        # split df_raw into frames that can be combined now and the TP frames of the last segment of every group.
+        # A segment is only emitted when the next first frame of its group arrives, so when a log file is
+        # processed in chunks, the open segments are held back and prepended to the next chunk. The open
+        # segments are never emitted from the first part
+        import numpy as np
+
+        if self.tp_type not in ["uds","nmea", "j1939"] or df_raw.empty:
+            return df_raw, df_raw.iloc[:0]
+
+        frame_struct = MultiFrameDecoder.FRAME_STRUCT[self.tp_type]
+        bam_pgn = frame_struct["bam_pgn"]
+
+        # positional index, so the TP frames can be mapped back to df_raw
+        df_raw_tp, df_raw_excl_tp, res_id_list, df_raw_pgns = self.identify_matching_ids(df_raw.reset_index(drop=True),
+                                                                                        frame_struct["res_id_list"], bam_pgn)
+        if len(df_raw_tp) == 0:
+            return df_raw, df_raw.iloc[:0]
+
+        order, group_start = self.group_tp_frames(df_raw_tp, res_id_list)
+        ids = df_raw_tp["ID"].to_numpy(dtype=np.int64)[order]
+        data_bytes = df_raw_tp["DataBytes"].to_numpy()[order]
+        byte_0 = np.fromiter((data[0] if len(data) > 0 else 0 for data in data_bytes), dtype=np.int64, count=len(order))
+        is_single, is_first = self.classify_tp_frames(ids, byte_0, bam_pgn, frame_struct["FIRST_FRAME_MASK"], frame_struct["FIRST_FRAME"],
+                                                      frame_struct["SINGLE_FRAME_MASK"], frame_struct["SINGLE_FRAME"])
+
+        # the last segment of a group is open if it starts with a first frame
+        seg_of_row = np.cumsum(is_first | group_start) - 1
+        seg_start = np.flatnonzero(is_first | group_start)
+        group_of_seg = np.cumsum(group_start)[seg_start]
+        seg_last = np.ones(len(seg_start), dtype=bool)
+        seg_last[:-1] = group_of_seg[1:] != group_of_seg[:-1]
+        seg_open = seg_last & is_first[seg_start]
+
+        tp_rows = df_raw_tp.index.to_numpy()
+        is_open = np.zeros(len(df_raw), dtype=bool)
+        is_open[tp_rows[order[seg_open[seg_of_row]]]] = True
+
+        # first frames of the open segments stay in both parts, they close the previous segments of their groups
+        is_ready = ~is_open
+        is_ready[tp_rows[order[seg_start[seg_open]]]] = True
+
+        return df_raw[is_ready], df_raw[is_open]
 
     def combine_tp_frames(self, df_raw):
         # main function that reassembles TP frames in df_raw
@@ -167,8 +255,6 @@ class MultiFrameDecoder:
         first_frame = frame_struct["FIRST_FRAME"]
         single_frame_mask = frame_struct["SINGLE_FRAME_MASK"]
         single_frame = frame_struct["SINGLE_FRAME"]
-        conseq_frame_mask = frame_struct["CONSEQ_FRAME_MASK"]
-        conseq_frame = frame_struct["CONSEQ_FRAME"]
 
         # split df_raw in two (incl/excl TP frames)
         df_raw_tp,  df_raw_excl_tp, res_id_list, df_raw_pgns = self.identify_matching_ids(df_raw,res_id_list_full, bam_pgn)
@@ -176,78 +262,132 @@ class MultiFrameDecoder:
         # initiate new df_raw that will contain both the df_raw excl. TP frames and subsequently all combined TP frames
         df_raw = [df_raw_excl_tp]
 
-        # for NMEA, apply PGN decoding outside loop
-        if self.tp_type == "nmea":
-            df_raw_tp_pgns = df_raw_tp["ID"].apply(self.calculate_pgn)
-        else:
-            df_raw_tp_pgns = None
-
-        # loop through each relevant TP response ID
-        for res_id in res_id_list:
-
-            # get subset of df_raw_tp containing res_id
-            df_raw_tp_res_id = self.filter_df_raw_tp(df_raw_tp,df_raw_tp_pgns, res_id)
-
-            # distinguish channels
-            for channel, df_channel in df_raw_tp_res_id.groupby("BusChannel"):
-
-                # distinguish IDs from PGNs by grouping on ID (or SA for J1939)
-                for identifier, df_raw_filter in df_channel.groupby(frame_struct["group"]):
-                    base_frame = df_raw_filter.iloc[0]
-                    frame_list = []
-                    frame_timestamp_list = []
-                    payload_concatenated = []
-
-                    ff_length = 0xFFF
-                    first_first_frame_test = True
-                    can_id = None
-                    conseq_frame_prev = None
-
-                    # iterate through rows in filtered dataframe
-                    for row in df_raw_filter.itertuples(index=True,name='Pandas'):
-                        index = row.Index
-                        first_frame_test = self.check_if_first_frame(row, bam_pgn, first_frame_mask,first_frame)
-                        first_byte = row.DataBytes[0]
-
-                        # if single frame, save frame directly (excl. 1st byte)
-                        if self.tp_type != "nmea" and (first_byte & single_frame_mask == single_frame):
-                            new_frame = self.construct_new_tp_frame(base_frame, row.DataBytes, row.ID)
-                            frame_list.append(new_frame.values.tolist())
-                            frame_timestamp_list.append(index)
-
-                        # if first frame, save info from prior multi frame response sequence,
-                        # then initialize a new sequence incl. the first frame payload
-                        elif first_frame_test:
-                            # create a new frame using information from previous iterations
-                            if len(payload_concatenated) >= ff_length:
-                                new_frame = self.construct_new_tp_frame(base_frame, payload_concatenated, can_id)
-                                frame_list.append(new_frame.values.tolist())
-                                frame_timestamp_list.append(frame_timestamp)
-
-                            # reset and start next frame with timestamp & CAN ID from this first frame plus initial payload
-                            conseq_frame_prev = None
-                            frame_timestamp = index
-
-                            if self.tp_type == "j1939":
-                                can_id = self.pgn_to_can_id(row)
-
-                            ff_length = self.get_payload_length(row)
-                            payload_concatenated = row.DataBytes[ff_payload_start:]
-
-                        # if consequtive frame, extend payload with payload excl. 1st byte
-                        elif (conseq_frame_prev == None) or ((first_byte - conseq_frame_prev) == 1):
-                            conseq_frame_prev = first_byte
-                            payload_concatenated += row.DataBytes[1:]
-
-
-                    df_raw_res_id_new = pd.DataFrame(frame_list, columns=base_frame.index, index=frame_timestamp_list)
-                    df_raw.append(df_raw_res_id_new)
+        if len(df_raw_tp) > 0:
+            df_raw.append(self.reassemble_tp_frames(df_raw_tp, res_id_list, bam_pgn, ff_payload_start,
+                                                    first_frame_mask, first_frame, single_frame_mask, single_frame))
 
         # exclude empty dataframes
         non_empty_df_list = [df for df in df_raw if not df.empty]
-        # concat
-        df_raw = pd.concat(non_empty_df_list, join='outer')
+        # concat, all frames can be dropped when only incomplete TP sequences are present
+        df_raw = pd.concat(non_empty_df_list, join='outer') if len(non_empty_df_list) > 0 else df_raw_excl_tp
 
         df_raw.index.name = "TimeStamp"
         df_raw = df_raw.sort_index()
-        return df_raw
\ No newline at end of file
+        return df_raw
+
+    def reassemble_tp_frames(self, df_raw_tp, res_id_list, bam_pgn, ff_payload_start,
+                             first_frame_mask, first_frame, single_frame_mask, single_frame):
+        # reassemble all TP frames at once. Every group (response ID, channel, ID or SA) is split into segments
+        # starting with a first frame. A segment is emitted as a new frame when the next first frame of the group
+        # arrives and enough payload was collected, single frames are emitted directly
+        import itertools
+        import numpy as np
+        import pandas as pd
+
+        df_raw_tp = df_raw_tp.copy()
+        if self.tp_type == "j1939":
+            df_raw_tp["SA"] = df_raw_tp["ID"].to_numpy(dtype=np.int64) & 0x000000FF
+
+        order, group_start = self.group_tp_frames(df_raw_tp, res_id_list)
+        num_rows = len(order)
+
+        # concatenate all payloads into one byte buffer
+        data_bytes = df_raw_tp["DataBytes"].to_numpy()[order]
+        lengths = np.fromiter(map(len, data_bytes), dtype=np.int64, count=num_rows)
+        offsets = np.zeros(num_rows, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)[:-1]
+        buffer = np.fromiter(itertools.chain.from_iterable(data_bytes), dtype=np.uint8, count=int(lengths.sum()))
+
+        def byte_at(pos):
+            # pos-th byte of every frame, 0 if the frame is shorter
+            valid = lengths > pos
+            result = np.zeros(num_rows, dtype=np.int64)
+            result[valid] = buffer[offsets[valid] + pos]
+            return result
+
+        ids = df_raw_tp["ID"].to_numpy(dtype=np.int64)[order]
+        byte_0 = byte_at(0)
+
+        # classify frames
+        is_single, is_first = self.classify_tp_frames(ids, byte_0, bam_pgn, first_frame_mask, first_frame,
+                                                      single_frame_mask, single_frame)
+        is_conseq = ~is_single & ~is_first
+
+        # segments - each first frame starts a new one, rows before the first first frame of a group
+        # form a segment without a first frame, which is never emitted
+        seg_of_row = np.cumsum(is_first | group_start) - 1
+        seg_start = np.flatnonzero(is_first | group_start)
+        seg_has_first = is_first[seg_start]
+        group_of_seg = np.cumsum(group_start)[seg_start]
+
+        # a segment is closed by the next first frame of the same group
+        seg_closed = np.zeros(len(seg_start), dtype=bool)
+        seg_closed[:-1] = (group_of_seg[1:] == group_of_seg[:-1]) & seg_has_first[1:]
+        seg_close_row = np.full(len(seg_start), num_rows, dtype=np.int64)
+        seg_close_row[:-1] = seg_start[1:]
+
+        # consequtive frames accepted into the payload
+        conseq_rows = np.flatnonzero(is_conseq)
+        conseq_rows = conseq_rows[self.accept_conseq_frames(byte_0[conseq_rows], seg_of_row[conseq_rows])]
+
+        # payload parts - first frame from ff_payload_start, consequtive frames without their first byte
+        first_rows = seg_start[seg_has_first]
+        part_rows = np.concatenate((first_rows, conseq_rows))
+        part_skip = np.concatenate((np.full(len(first_rows), ff_payload_start), np.ones(len(conseq_rows), dtype=np.int64)))
+        part_order = np.argsort(part_rows, kind="stable")
+        part_rows, part_skip = part_rows[part_order], part_skip[part_order]
+        part_lengths = np.maximum(lengths[part_rows] - part_skip, 0)
+
+        payload_lengths = np.bincount(seg_of_row[part_rows], weights=part_lengths, minlength=len(seg_start)).astype(np.int64)
+
+        # frames to emit
+        ff_length = np.full(len(seg_start), 0xFFF, dtype=np.int64)
+        ff_length[seg_has_first] = self.get_payload_lengths(byte_0, byte_at(1))[first_rows]
+        seg_emit = seg_closed & seg_has_first & (payload_lengths >= ff_length)
+
+        # gather the payload bytes of emitted segments
+        part_emit = seg_emit[seg_of_row[part_rows]]
+        part_rows, part_skip, part_lengths = part_rows[part_emit], part_skip[part_emit], part_lengths[part_emit]
+        part_begin = offsets[part_rows] + part_skip
+        part_pos = np.zeros(len(part_lengths), dtype=np.int64)
+        part_pos[1:] = np.cumsum(part_lengths)[:-1]
+        gather = np.repeat(part_begin - part_pos, part_lengths) + np.arange(int(part_lengths.sum()), dtype=np.int64)
+        payloads = np.split(buffer[gather], np.cumsum(payload_lengths[seg_emit])[:-1]) if seg_emit.any() else []
+
+        # new frames are emitted in the order in which they were completed
+        emit_seg = np.flatnonzero(seg_emit)
+        single_rows = np.flatnonzero(is_single)
+        trigger = np.concatenate((seg_close_row[emit_seg], single_rows))
+        source_row = np.concatenate((seg_start[emit_seg], single_rows))
+        new_payloads = [payload.tolist() for payload in payloads] + [data_bytes[row] for row in single_rows]
+
+        # J1939 frames get the CAN ID of the transported PGN, single frames keep their own ID
+        if self.tp_type == "j1939":
+            seg_ids = self.pgns_to_can_ids(byte_at(5), byte_at(6), byte_at(7), ids & 0x000000FF)[seg_start[emit_seg]]
+        else:
+            seg_ids = np.full(len(emit_seg), -1, dtype=np.int64)
+        new_ids = np.concatenate((seg_ids, ids[single_rows]))
+
+        emit_order = np.argsort(trigger, kind="stable")
+        source_row = source_row[emit_order]
+        new_ids = new_ids[emit_order]
+        new_payloads = [new_payloads[pos] for pos in emit_order]
+
+        # all other columns are taken from the first frame of the group
+        base_row = np.maximum.accumulate(np.where(group_start, np.arange(num_rows), 0))[source_row]
+        base_ids = ids[base_row]
+
+        new_frame = {}
+        for column in df_raw_tp.columns:
+            if column == "DataBytes":
+                new_frame[column] = new_payloads
+            elif column == "DLC":
+                new_frame[column] = [0] * len(source_row)
+            elif column == "DataLength":
+                new_frame[column] = [len(payload) for payload in new_payloads]
+            elif column == "ID":
+                new_frame[column] = np.where(new_ids > 0, new_ids, base_ids)
+            else:
+                new_frame[column] = df_raw_tp[column].to_numpy()[order][base_row]
+
+        return pd.DataFrame(new_frame, columns=df_raw_tp.columns, index=df_raw_tp.index[order][source_row])
@@ -0,0 +1,155 @@
+# Made by Ondrej Luks, 2023
+# ondrej.luks@doosan.com
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+from urllib.parse import quote
+from .communication import PipeCommunication
+from .sink import DataSink
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import hashlib
+import shutil
+import os
+
+# partition value of signals without a device id, as used by pyarrow
+NO_DEVICE = "__HIVE_DEFAULT_PARTITION__"
+# rows of one parquet row group, every row group keeps its own min/max statistics
+ROW_GROUP_ROWS = 100000
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+class ParquetSink(DataSink):
+    """Local Parquet dataset used instead of the database. Signals are stored in
+    <parquet_path>/signals/device=<id>/date=<yyyy-mm-dd>/ and rollups in
+    <parquet_path>/rollups/resolution=<res>/device=<id>/date=<yyyy-mm-dd>/
+    (hive partitioning readable by pyarrow.dataset or DuckDB). Every upload writes one file
+    per partition, holding all its signals in the signal column. Files are named by their content,
+    so uploading the same data again replaces them. Data uploaded in different pieces (other
+    stream_chunk_rows or aggregation settings) is appended again, as the dataset has no keys."""
+
+    def __init__(self, config, communication: PipeCommunication, event):
+        self._comm = communication
+        self._stop_event = event
+
+        try:
+            self._path = config["settings"]["parquet_path"]
+            self._clean = config["settings"]["clean_upload"] == "true"
+
+        except Exception as e:
+            self._comm.send_error("ERROR", f"Problem with creating parquet sink:\n{e}", "T")
+            return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def create_schema(self) -> None:
+        """Creates the dataset directory if not exists"""
+        try:
+            if self._clean and os.path.isdir(self._path):
+                # clean upload is selected
+                self._comm.send_to_print(f" - Deleting dataset {self._path}")
+                shutil.rmtree(self._path)
+
+            os.makedirs(self._path, exist_ok=True)
+
+        except Exception as e:
+            self._comm.send_error("ERROR", f"Error with parquet dataset:\n{e}", "T")
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _partition(self, name: str, value: str) -> str:
+        """Returns a hive partition directory name, the value is URI encoded as expected by pyarrow"""
+        return f"{name}={quote(value, safe='') if value else NO_DEVICE}"
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def _write_days(self, table_df: pd.DataFrame, directory: str) -> None:
+        """Writes the dataframe indexed by time stamps into one file per day partition of the directory, named
+        by the hash of its rows. Rows keep their order (by signal, then time), so row group statistics stay selective.
+        Files are written under a hidden name first, so readers never see half-written files."""
+        days = table_df.index.floor("D")
+
+        for day, day_df in table_df.groupby(days, sort=True):
+            day_dir = os.path.join(directory, f"date={day.strftime('%Y-%m-%d')}")
+            os.makedirs(day_dir, exist_ok=True)
+
+            day_df = day_df.reset_index()
+            file_name = f"{hashlib.sha1(pd.util.hash_pandas_object(day_df, index=False).to_numpy().tobytes()).hexdigest()}.parquet"
+            temp_path = os.path.join(day_dir, f".{file_name}")
+            table = pa.Table.from_pandas(day_df, preserve_index=False)
+            pq.write_table(table, temp_path, compression="zstd", row_group_size=ROW_GROUP_ROWS,
+                           use_dictionary=["signal"], column_encoding={"time_stamp": "DELTA_BINARY_PACKED"})
+            os.replace(temp_path, os.path.join(day_dir, file_name))
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def upload_data(self, data: list, progress: callable, device_id: str = None) -> None:
+        """Appends given list of dataframes to the dataset. Values are stored as floats, the same as in
+        the long database layout, so all signals share one schema and non-numeric signals are skipped."""
+        frames = []
+
+        for df_count, df in enumerate(data):
+            # thread end check
+            if self._stop_event.is_set():
+                print("Parquet upload aborted.")
+                return
+
+            try:
+                signal = f"{df.columns.values[0]}"
+                if not (pd.api.types.is_numeric_dtype(df.dtypes.iloc[0]) or pd.api.types.is_bool_dtype(df.dtypes.iloc[0])):
+                    self._comm.send_to_print(f"       - WARNING: Skipping signal {signal}, parquet dataset stores numeric values only.")
+                    progress(df_count / len(data))
+                    continue
+
+                self._comm.send_to_print(f"     > storing signal: {signal}")
+
+                frames.append(pd.DataFrame({"signal": signal, "value": df.iloc[:, 0].astype("float64")}, index=df.index.rename("time_stamp")))
+
+            except Exception as e:
+                self._comm.send_error("WARNING", f"Problem with parquet upload:\n{e}", "F")
+
+            # update progress bar
+            progress(df_count / len(data))
+
+        if len(frames) == 0:
+            return
+
+        try:
+            self._write_days(pd.concat(frames), os.path.join(self._path, "signals", self._partition("device", device_id)))
+
+        except Exception as e:
+            self._comm.send_error("WARNING", f"Problem with parquet upload:\n{e}", "F")
+
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def upload_rollups(self, rollups: list, device_id: str = None) -> None:
+        """Appends rollup statistics of one device given as a list of (signal, resolution, dataframe)"""
+        resolutions = {}
+        for signal, resolution, df in rollups:
+            resolutions.setdefault(resolution, []).append(df.rename_axis("time_stamp").assign(signal=f"{signal}")[["signal", *df.columns]])
+
+        for resolution, frames in resolutions.items():
+            # thread end check
+            if self._stop_event.is_set():
+                print("Parquet upload aborted.")
+                break
+
+            try:
+                directory = os.path.join(self._path, "rollups", self._partition("resolution", resolution), self._partition("device", device_id))
+                self._write_days(pd.concat(frames), directory)
+
+            except Exception as e:
+                self._comm.send_error("WARNING", f"Problem with parquet rollup upload:\n{e}", "F")
+
+        return
@@ -18,7 +18,8 @@ class ProcessData:
 
     def extract_phys(self, df_raw):
         """Given df of raw data and list of decoding databases, create new def with
-        physical values (no duplicate signals and optionally filtered/rebaselined)
+        physical values (optionally filtered/rebaselined). Databases are expected to be
+        merged per protocol (see merge_signal_dbs), so no signal is decoded twice
         """
         import can_decoder
         import pandas as pd
@@ -34,13 +35,12 @@ class ProcessData:
                     if not df_phys_group.empty:
                         df_phys_group["BusChannel"] = bus 
                     df_phys_temp.append(df_phys_group)
-                    
+
+        if len(df_phys_temp) == 0:
+            # no decodable frames
+            return df_phys
+
         df_phys = pd.concat(df_phys_temp, ignore_index=False).sort_index()
-        
-        # remove duplicates in case multiple DBC files contain identical signals
-        df_phys["datetime"] = df_phys.index
-        df_phys = df_phys.drop_duplicates(keep="first")
-        df_phys = df_phys.drop(labels="datetime", axis=1)
 
         # optionally filter and rebaseline the data
         df_phys = self.filter_signals(df_phys)
@@ -0,0 +1,60 @@
+# Made by Ondrej Luks, 2023
+# ondrej.luks@doosan.com
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+from abc import ABC, abstractmethod
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+class DataSink(ABC):
+    """Destination of converted signals. Conversion stores its results only through these methods,
+    so the database can be replaced by another storage.
+
+    Methods
+    -------
+    - connect ()
+    - create_schema ()
+    - set_signal_messages (signal_messages)
+    - upload_data (data, progress, device_id)
+    - upload_rollups (rollups, device_id)
+    - finish ()
+    """
+
+    def connect(self) -> None:
+        """Opens the storage before the conversion"""
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def create_schema(self) -> None:
+        """Prepares the storage for the conversion, clears it on clean upload"""
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def set_signal_messages(self, signal_messages: dict) -> None:
+        """Sets the DBC message of every signal"""
+        return
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    @abstractmethod
+    def upload_data(self, data: list, progress: callable, device_id: str = None) -> None:
+        """Stores given list of single-signal dataframes of one device. Progress callback receives stored part of the data (0 - 1)."""
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    @abstractmethod
+    def upload_rollups(self, rollups: list, device_id: str = None) -> None:
+        """Stores rollup statistics of one device given as a list of (signal, resolution, dataframe)"""
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+    def finish(self) -> None:
+        """Closes the storage"""
+        return
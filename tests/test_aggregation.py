@@ -0,0 +1,164 @@
+# Made by Ondrej Luks, 2023
+# ondrej.luks@doosan.com
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "App"))
+
+import src.aggregation as aggregation
+from src.aggregation import change_point_indices, aggregate_chunk, aggregate_shared, time_stamps_ns, SignalAggregator, SharedSignalBuffer, tolerance_change_points
+
+SECOND = 1_000_000_000
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+def baseline_indices(values: np.ndarray, time_stamps: np.ndarray, max_skip_ns: int) -> np.ndarray:
+    """Per-row loop of the original Conversion._aggregate used as the reference"""
+    idx_array = [0]
+    previous = 0
+    for idx in range(len(values)):
+        time_diff = time_stamps[idx] - time_stamps[previous]
+        if values[previous] != values[idx]:
+            idx_array.append(idx - 1)
+            idx_array.append(idx)
+            previous = idx
+        elif time_diff > max_skip_ns:
+            idx_array.append(idx)
+            previous = idx
+
+    idx_array.append(len(values) - 1)
+    return np.array(list(dict.fromkeys(idx_array)), dtype=np.int64)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def random_signal(rng: np.random.Generator, num_rows: int) -> tuple:
+    """Returns values with long constant runs and time stamps with occasional gaps longer than the max skip"""
+    values = np.cumsum(rng.random(num_rows) < rng.uniform(0.01, 0.5)).astype(np.float64)
+    steps = rng.integers(1, 2 * SECOND, num_rows)
+    gaps = rng.random(num_rows) < 0.05
+    steps[gaps] += rng.integers(5 * SECOND, 60 * SECOND, int(gaps.sum()))
+    return values, np.cumsum(steps).astype(np.int64)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def chunked_indices(values: np.ndarray, time_stamps: np.ndarray, max_skip_ns: int, bounds: list) -> np.ndarray:
+    """Aggregates the signal split at given row bounds the way Conversion does for streamed files"""
+    df = pd.DataFrame({"sig": values}, index=pd.to_datetime(time_stamps, utc=True))
+    df["row"] = np.arange(len(values))
+    aggregator = SignalAggregator("sig")
+    kept = []
+
+    for chunk_idx, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        final = chunk_idx == len(bounds) - 2
+        extended = aggregator.extend(df.iloc[start:stop])
+        result = aggregate_chunk(extended["sig"].to_numpy(), time_stamps_ns(extended.index), max_skip_ns, *aggregator.state(), final)
+        kept.append(aggregator.update(extended, result, final)["row"].to_numpy())
+
+    return np.concatenate(kept)
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_matches_baseline(seed):
+    rng = np.random.default_rng(seed)
+    values, time_stamps = random_signal(rng, int(rng.integers(1, 500)))
+    max_skip_ns = int(rng.integers(1, 10)) * SECOND
+
+    np.testing.assert_array_equal(change_point_indices(values, time_stamps, max_skip_ns),
+                                  baseline_indices(values, time_stamps, max_skip_ns))
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def test_gap_split():
+    # the value stays the same, every gap longer than the max skip adds a heartbeat
+    values = np.zeros(8)
+    time_stamps = np.array([0, 1, 2, 20, 21, 22, 40, 41], dtype=np.int64) * SECOND
+
+    np.testing.assert_array_equal(change_point_indices(values, time_stamps, 5 * SECOND),
+                                  baseline_indices(values, time_stamps, 5 * SECOND))
+    np.testing.assert_array_equal(change_point_indices(values, time_stamps, 5 * SECOND), [0, 3, 6, 7])
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def test_single_row():
+    np.testing.assert_array_equal(change_point_indices(np.array([1.0]), np.array([0], dtype=np.int64), SECOND), [0])
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_chunk_boundaries(seed):
+    rng = np.random.default_rng(seed)
+    values, time_stamps = random_signal(rng, int(rng.integers(2, 500)))
+    max_skip_ns = int(rng.integers(1, 10)) * SECOND
+    cuts = sorted(set(rng.integers(1, len(values), int(rng.integers(0, 6))).tolist()))
+    bounds = [0] + cuts + [len(values)]
+
+    np.testing.assert_array_equal(chunked_indices(values, time_stamps, max_skip_ns, bounds),
+                                  baseline_indices(values, time_stamps, max_skip_ns))
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+@pytest.mark.skipif(aggregation._tolerance_kernel is None, reason="numba is not installed")
+@pytest.mark.parametrize("method", ["deadband", "swinging_door"])
+@pytest.mark.parametrize("seed", range(50))
+def test_tolerance_kernel_matches_numpy(monkeypatch, method, seed):
+    rng = np.random.default_rng(seed)
+    values, time_stamps = random_signal(rng, int(rng.integers(2, 500)))
+    values += rng.normal(0, 0.3, len(values))
+    max_skip_ns = int(rng.integers(1, 10)) * SECOND
+    abs_band, rel_band = float(rng.choice([0.0, 0.5])), float(rng.choice([0.0, 0.1]))
+
+    # a new signal and a chunk continuing after its first sample
+    arguments = [(values, time_stamps, max_skip_ns, method, abs_band, rel_band, None, None, False),
+                 (values[1:], time_stamps[1:], max_skip_ns, method, abs_band, rel_band, int(time_stamps[0]), float(values[0]), False)]
+
+    compiled = [tolerance_change_points(*args) for args in arguments]
+    monkeypatch.setattr(aggregation, "_tolerance_kernel", None)
+    reference = [tolerance_change_points(*args) for args in arguments]
+
+    for compiled_result, reference_result in zip(compiled, reference):
+        np.testing.assert_array_equal(compiled_result[0], reference_result[0])
+        assert compiled_result[1:] == reference_result[1:]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def test_shared_buffer_keeps_dtypes():
+    # integers above 2**53 differ by less than the float64 resolution
+    time_stamps = np.arange(6, dtype=np.int64) * SECOND
+    index = pd.to_datetime(time_stamps, utc=True)
+    signals = [pd.DataFrame({"counter": np.array([2**53, 2**53 + 1, 2**53 + 1, 2**53 + 2, 2**53 + 2, 2**53 + 2], dtype=np.int64)}, index=index),
+               pd.DataFrame({"voltage": np.array([1.5, 1.5, 2.5, 2.5, 2.5, 3.5])}, index=index),
+               pd.DataFrame({"state": np.array([1, 1, 1, 2, 2, 2], dtype=np.uint8)}, index=index),
+               pd.DataFrame({"name": ["a", "a", "b", "b", "b", "b"]}, index=index)]
+
+    buffer = SharedSignalBuffer(signals)
+    try:
+        assert [buffer.shared(sig_idx) for sig_idx in range(len(signals))] == [True, True, True, False]
+        for sig_idx, df in enumerate(signals[:3]):
+            expected = aggregate_chunk(df.iloc[:, 0].to_numpy(), time_stamps, 100 * SECOND)
+            result = aggregate_shared(*buffer.task(sig_idx), 100 * SECOND)
+            np.testing.assert_array_equal(result[0], expected[0])
+
+        np.testing.assert_array_equal(aggregate_shared(*buffer.task(0), 100 * SECOND)[0], [0, 1, 2, 3, 5])
+
+    finally:
+        buffer.release()
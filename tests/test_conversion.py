@@ -0,0 +1,100 @@
+# Made by Ondrej Luks, 2023
+# ondrej.luks@doosan.com
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+import os
+import sys
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "App"))
+
+from src.conversion import Conversion
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+class Communication:
+    """Stores messages instead of sending them to the GUI"""
+
+    def __init__(self):
+        self.messages = []
+
+    def send_to_print(self, message: str = "") -> None:
+        self.messages.append(message)
+
+    def send_command(self, command: str) -> None:
+        self.messages.append(command)
+
+    def send_error(self, *error) -> None:
+        self.messages.append(error)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def make_conversion() -> Conversion:
+    """Returns a conversion of a single file without database and utilities"""
+    conversion = Conversion(None, Communication(), None, threading.Event(), [], {"settings": {}})
+    conversion._num_of_files = 1
+    conversion._file_progress = [0]
+    return conversion
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def baseline_split(df: pd.DataFrame) -> list:
+    """Per-signal boolean mask of the original Conversion._split_df_by_cols used as the reference"""
+    column_df = []
+    for signal_name in df['Signal'].unique():
+        signal_df = df[df['Signal'] == signal_name][['Physical Value']].copy()
+        signal_df.rename(columns={'Physical Value': signal_name}, inplace=True)
+        column_df.append(signal_df)
+
+    return column_df
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def random_phys(rng: np.random.Generator, num_rows: int) -> pd.DataFrame:
+    """Returns a decoded dataframe of interleaved signals with repeated time stamps"""
+    time_stamps = np.sort(rng.integers(0, 10**12, num_rows)) + 1_700_000_000_000_000_000
+    time_stamps[1::7] = time_stamps[0::7][:len(time_stamps[1::7])]
+    signals = rng.choice([f"signal_{idx}" for idx in range(int(rng.integers(1, 12)))], num_rows)
+
+    return pd.DataFrame({"Signal": signals, "Physical Value": rng.normal(0, 100, num_rows)},
+                        index=pd.DatetimeIndex(pd.to_datetime(time_stamps, utc=True), name="TimeStamp"))
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_split_matches_baseline(seed):
+    df = random_phys(np.random.default_rng(seed), int(np.random.default_rng(seed).integers(1, 2000)))
+    result = make_conversion()._split_df_by_cols(df, 0)
+    expected = baseline_split(df)
+
+    assert len(result) == len(expected)
+    for result_df, expected_df in zip(result, expected):
+        pd.testing.assert_frame_equal(result_df, expected_df)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def test_split_without_signals():
+    df = pd.DataFrame(index=pd.DatetimeIndex([], tz="UTC", name="TimeStamp"))
+    assert make_conversion()._split_df_by_cols(df, 0) == []
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def test_split_stopped():
+    conversion = make_conversion()
+    conversion._stop_event.set()
+    assert conversion._split_df_by_cols(random_phys(np.random.default_rng(0), 10), 0) is None
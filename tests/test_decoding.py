@@ -0,0 +1,251 @@
+# Made by Ondrej Luks, 2023
+# ondrej.luks@doosan.com
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+import os
+import sys
+import fnmatch
+import numpy as np
+import pandas as pd
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "App")
+sys.path.insert(0, APP_PATH)
+
+import can_decoder
+import src.decoding as decoding
+from src.decoding import load_dbc, decode_mf4, decode_mf4_chunks, merge_signal_dbs, prefilter_frames, filter_signal_dbs
+from src.proc_data import ProcessData
+
+DBC_PATH = os.path.join(APP_PATH, "DBCfiles")
+DBC_FILES = ["dm1_reduc.dbc", "Curtis_Inverter_ZTR_Mower_reduct.dbc"]
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+def raw_frames(seed: int, num_of_events: int = 300) -> pd.DataFrame:
+    """Returns a raw dataframe as read by get_data_frame with single J1939 DM1 frames, DM1 messages sent
+    by J1939 TP (BAM) from two source addresses, other J1939 frames and frames no DBC decodes, on two buses"""
+    rng = np.random.default_rng(seed)
+    frames = []
+
+    for _ in range(num_of_events):
+        bus = int(rng.integers(1, 3))
+        kind = rng.integers(0, 4)
+
+        if kind == 0:
+            frames.append((bus, 0x18FECA49, 1, list(rng.integers(0, 256, 8))))
+
+        elif kind == 1:
+            # BAM announcement followed by the data packets, sometimes cut short
+            sa = int(rng.choice([0xF3, 0xEF]))
+            size = int(rng.integers(9, 30))
+            packets = (size + 6) // 7
+            frames.append((bus, 0x18ECFF00 | sa, 1, [0x20, size & 0xFF, size >> 8, packets, 0xFF, 0xCA, 0xFE, 0x00]))
+            sent = packets if rng.random() > 0.1 else int(rng.integers(1, packets + 1))
+            for seq in range(1, sent + 1):
+                frames.append((bus, 0x18EBFF00 | sa, 1, [seq] + list(rng.integers(0, 256, 7))))
+
+        elif kind == 2:
+            frames.append((bus, int(rng.choice([0x18FB72F2, 0x0CFB74F2])), 1, list(rng.integers(0, 256, 8))))
+
+        else:
+            frames.append((bus, 0x123, 0, list(rng.integers(0, 256, 8))))
+
+    time_stamps = 1_700_000_000_000_000_000 + np.cumsum(rng.integers(1, 5_000_000, len(frames)))
+    index = pd.to_datetime(time_stamps, utc=True)
+    index.name = "TimeStamp"
+    lengths = np.array([len(data) for _, _, _, data in frames], dtype=np.uint8)
+
+    return pd.DataFrame({"BusChannel": np.array([bus for bus, _, _, _ in frames], dtype=np.uint8),
+                         "ID": np.array([can_id for _, can_id, _, _ in frames], dtype=np.uint32),
+                         "IDE": np.array([ide for _, _, ide, _ in frames], dtype=np.uint8),
+                         "DLC": lengths,
+                         "DataLength": lengths,
+                         "DataBytes": [[int(byte) for byte in data] for _, _, _, data in frames]}, index=index)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def sorted_phys(df_phys: pd.DataFrame) -> pd.DataFrame:
+    """Returns decoded rows in a defined order, rows of equal time stamps may come in any order"""
+    df_phys = df_phys.reset_index()
+    return df_phys.sort_values(list(df_phys.columns), kind="stable").reset_index(drop=True)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def db_frames(db_list: list, seed: int, num_of_frames: int = 5000) -> pd.DataFrame:
+    """Returns a raw dataframe of random frames of all messages of given databases (J1939 ones from
+    random source addresses) and frames no database decodes, on two buses"""
+    rng = np.random.default_rng(seed)
+    fused_ids = np.array([frame_id for db in db_list for frame_id in db.frames] + [0x123, 0x80000000 | 0x18FEEE00], dtype=np.int64)
+    fused_ids = fused_ids[rng.integers(0, len(fused_ids), num_of_frames)]
+    extended = (fused_ids >> 31) & 1
+    can_ids = np.where(extended == 1, (fused_ids & 0x1FFFFF00) | rng.integers(0, 3, num_of_frames), fused_ids & 0x1FFFFFFF)
+
+    index = pd.to_datetime(1_700_000_000_000_000_000 + np.arange(num_of_frames) * 1_000_000, utc=True)
+    index.name = "TimeStamp"
+
+    return pd.DataFrame({"BusChannel": rng.integers(1, 3, num_of_frames).astype(np.uint8),
+                         "ID": can_ids.astype(np.uint32),
+                         "IDE": extended.astype(np.uint8),
+                         "DLC": np.full(num_of_frames, 8, dtype=np.uint8),
+                         "DataLength": np.full(num_of_frames, 8, dtype=np.uint8),
+                         "DataBytes": [[int(byte) for byte in data] for data in rng.integers(0, 256, (num_of_frames, 8))]}, index=index)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def baseline_extract_phys(df_raw: pd.DataFrame, db_list: list) -> pd.DataFrame:
+    """Decoding by every DBC database separately of the original ProcessData.extract_phys used as the reference"""
+    df_phys_temp = []
+    for db in db_list:
+        df_decoder = can_decoder.DataFrameDecoder(db)
+
+        for bus, bus_group in df_raw.groupby("BusChannel"):
+            for length, group in bus_group.groupby("DataLength"):
+                df_phys_group = df_decoder.decode_frame(group)
+                if not df_phys_group.empty:
+                    df_phys_group["BusChannel"] = bus
+                df_phys_temp.append(df_phys_group)
+
+    df_phys = pd.concat(df_phys_temp, ignore_index=False).sort_index()
+
+    # remove duplicates in case multiple DBC files contain identical signals
+    df_phys["datetime"] = df_phys.index
+    df_phys = df_phys.drop_duplicates(keep="first")
+    return df_phys.drop(labels="datetime", axis=1)
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+@pytest.fixture(scope="module")
+def dbc_list():
+    return [load_dbc(os.path.join(DBC_PATH, dbc_file), cache_path="") for dbc_file in DBC_FILES]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+@pytest.fixture(scope="module")
+def all_dbc_list():
+    return [load_dbc(os.path.join(DBC_PATH, dbc_file), cache_path="") for dbc_file in sorted(os.listdir(DBC_PATH)) if dbc_file.endswith(".dbc")]
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("chunk_rows", [5, 64, 100000])
+def test_chunks_match_whole_file(monkeypatch, dbc_list, seed, chunk_rows):
+    df_raw = raw_frames(seed)
+
+    def get_raw_data(self, log_file, passwords={}, lin=False):
+        return df_raw.copy(), "device"
+
+    def read_raw_chunks(mf4_file, rows, proc):
+        for start in range(0, df_raw.shape[0], rows):
+            yield df_raw.iloc[start:start + rows].copy(), "device"
+
+    monkeypatch.setattr(ProcessData, "get_raw_data", get_raw_data)
+    monkeypatch.setattr(decoding, "read_raw_chunks", read_raw_chunks)
+
+    df_whole, skipped_frames, skipped_bytes, device_id = decode_mf4("log.mf4", dbc_list)
+    chunks = list(decode_mf4_chunks("log.mf4", dbc_list, chunk_rows))
+
+    assert df_whole.shape[0] > 0
+    assert all(chunk[3] == device_id for chunk in chunks)
+    pd.testing.assert_frame_equal(sorted_phys(pd.concat([chunk[0] for chunk in chunks])), sorted_phys(df_whole), check_dtype=False)
+    assert sum(chunk[1] for chunk in chunks) == skipped_frames
+    assert sum(chunk[2] for chunk in chunks) == skipped_bytes
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+@pytest.mark.filterwarnings("ignore:No data found for signal")
+@pytest.mark.parametrize("seed", range(3))
+def test_merged_dbs_match_baseline(all_dbc_list, seed):
+    df_raw = db_frames(all_dbc_list, seed)
+    df_phys = ProcessData(None, merge_signal_dbs(all_dbc_list)).extract_phys(df_raw)
+
+    assert df_phys.shape[0] > 0
+    pd.testing.assert_frame_equal(sorted_phys(df_phys), sorted_phys(baseline_extract_phys(df_raw, all_dbc_list)), check_dtype=False)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+@pytest.mark.filterwarnings("ignore:No data found for signal")
+def test_merged_dbs_decode_once(dbc_list):
+    # the same DBC files loaded twice decode every signal only once
+    df_raw = db_frames(dbc_list, 0)
+    pd.testing.assert_frame_equal(ProcessData(None, merge_signal_dbs(dbc_list + dbc_list)).extract_phys(df_raw),
+                                  ProcessData(None, merge_signal_dbs(dbc_list)).extract_phys(df_raw))
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+@pytest.mark.filterwarnings("ignore:No data found for signal")
+@pytest.mark.parametrize("seed", range(3))
+def test_prefilter_keeps_decoded_frames(all_dbc_list, seed):
+    merged_dbs = merge_signal_dbs(all_dbc_list)
+    df_raw = db_frames(all_dbc_list, seed)
+    # standard frames of random IDs, most of them are not in any DBC file
+    df_other = df_raw.assign(ID=np.random.default_rng(seed).integers(0, 0x7FF, df_raw.shape[0]).astype(np.uint32), IDE=np.uint8(0))
+    df_raw = pd.concat([df_raw, df_other]).sort_index(kind="stable")
+
+    df_kept, skipped_frames, skipped_bytes = prefilter_frames(df_raw, merged_dbs)
+    proc = ProcessData(None, merged_dbs)
+
+    assert 0 < skipped_frames < df_raw.shape[0]
+    assert df_kept.shape[0] + skipped_frames == df_raw.shape[0]
+    assert skipped_bytes == df_raw["DataLength"].sum() - df_kept["DataLength"].sum()
+    pd.testing.assert_frame_equal(sorted_phys(proc.extract_phys(df_kept)), sorted_phys(proc.extract_phys(df_raw)))
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def test_prefilter_empty(dbc_list):
+    df_raw = db_frames(dbc_list, 0)
+    assert prefilter_frames(df_raw.iloc[:0], dbc_list)[1:] == (0, 0)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+@pytest.mark.filterwarnings("ignore:No data found for signal")
+@pytest.mark.parametrize("patterns", [["SoC"], ["P1CellNTC0*", "*Temp*"], ["Inverter_?PN", "BusVoltage", "Unknown*"]])
+def test_allow_list_matches_full_decoding(all_dbc_list, patterns):
+    merged_dbs = merge_signal_dbs(all_dbc_list)
+    df_raw = db_frames(all_dbc_list, 0)
+    df_full = ProcessData(None, merged_dbs).extract_phys(df_raw)
+    df_full = df_full[[any(fnmatch.fnmatchcase(signal, pattern) for pattern in patterns) for signal in df_full["Signal"]]]
+
+    filtered_dbs = filter_signal_dbs(merged_dbs, patterns)
+    df_kept, skipped_frames, skipped_bytes = prefilter_frames(df_raw, filtered_dbs)
+
+    assert df_full.shape[0] > 0
+    pd.testing.assert_frame_equal(sorted_phys(ProcessData(None, filtered_dbs).extract_phys(df_kept)), sorted_phys(df_full), check_dtype=False)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def test_allow_list_prunes_multiplexers():
+    db_list = [load_dbc(os.path.join(DBC_PATH, "batterypacks.dbc"), cache_path="")]
+    filtered_dbs = filter_signal_dbs(db_list, ["Version_C21_Pack1"])
+
+    assert len(filtered_dbs) == 1 and list(filtered_dbs[0].frames) == [0x5B1]
+    multiplexer = filtered_dbs[0].frames[0x5B1].signals[0]
+    assert multiplexer.name == "selector_Pack1"
+    assert [signal.name for signals in multiplexer.signals.values() for signal in signals] == ["Version_C21_Pack1"]
+    # the loaded database stays untouched
+    assert len(db_list[0].frames[0x5B1].signals[0].signals) > 1
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def test_allow_list_empty(dbc_list):
+    assert filter_signal_dbs(dbc_list, []) is dbc_list
+    assert filter_signal_dbs(dbc_list, ["Unknown*"]) == []
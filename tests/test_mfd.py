@@ -0,0 +1,250 @@
+# Made by Ondrej Luks, 2023
+# ondrej.luks@doosan.com
+
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+import os
+import sys
+import random
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "App"))
+
+from src.mfd import MultiFrameDecoder
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+class BaselineDecoder(MultiFrameDecoder):
+    """The original row by row TP reassembly, kept as the reference of the vectorized one"""
+
+    def identify_matching_ids(self, df_raw, res_id_list_full, bam_pgn):
+        if self.tp_type == "nmea":
+            df_raw_pgns = df_raw["ID"].apply(self.calculate_pgn)
+            df_raw_match = df_raw_pgns.isin(res_id_list_full)
+            res_id_list = df_raw_pgns[df_raw_match].drop_duplicates().values.tolist()
+        if self.tp_type == "j1939":
+            df_raw_pgns = df_raw["ID"].apply(self.calculate_pgn)
+            df_raw_match = df_raw_pgns.isin(res_id_list_full)
+            res_id_list = res_id_list_full.copy()
+            res_id_list.remove(bam_pgn)
+        elif self.tp_type == "uds":
+            df_raw_pgns = None
+            df_raw_match = df_raw["ID"].isin(res_id_list_full)
+            res_id_list = df_raw["ID"][df_raw_match].drop_duplicates().values.tolist()
+
+        return df_raw[df_raw_match], df_raw[~df_raw_match], res_id_list, df_raw_pgns
+
+    def filter_df_raw_tp(self, df_raw_tp, df_raw_tp_pgns, res_id):
+        if self.tp_type == "nmea":
+            return df_raw_tp[df_raw_tp_pgns.isin([res_id])]
+        if self.tp_type == "j1939":
+            df_raw_tp_res_id = df_raw_tp.copy()
+            df_raw_tp_res_id["SA"] = df_raw_tp_res_id["ID"].apply(self.calculate_sa)
+            return df_raw_tp_res_id
+        return df_raw_tp[df_raw_tp["ID"].isin([res_id])]
+
+    def check_if_first_frame(self, row, bam_pgn, first_frame_mask, first_frame):
+        if self.tp_type == "j1939" and bam_pgn == self.calculate_pgn(row.ID):
+            return True
+        return (row.DataBytes[0] & first_frame_mask) == first_frame
+
+    def pgn_to_can_id(self, row):
+        pgn = int("".join("{:02x}".format(x) for x in reversed(row.DataBytes[5:8])), 16)
+        return (6 << 26) | (pgn << 8) | row.SA
+
+    def get_payload_length(self, row):
+        if self.tp_type == "uds":
+            return (row.DataBytes[0] & 0x0F) << 8 | row.DataBytes[1]
+        if self.tp_type == "nmea":
+            return row.DataBytes[1]
+        return int("".join("{:02x}".format(x) for x in reversed(row.DataBytes[1:2])), 16)
+
+    def construct_new_tp_frame(self, base_frame, payload_concatenated, can_id):
+        new_frame = base_frame.copy()
+        new_frame["DataBytes"] = payload_concatenated
+        new_frame["DLC"] = 0
+        new_frame["DataLength"] = len(payload_concatenated)
+        if can_id:
+            new_frame["ID"] = can_id
+        return new_frame
+
+    def combine_tp_frames(self, df_raw):
+        frame_struct = MultiFrameDecoder.FRAME_STRUCT[self.tp_type]
+        bam_pgn = frame_struct["bam_pgn"]
+        ff_payload_start = frame_struct["ff_payload_start"]
+
+        df_raw_tp, df_raw_excl_tp, res_id_list, df_raw_pgns = self.identify_matching_ids(df_raw, frame_struct["res_id_list"], bam_pgn)
+        df_raw = [df_raw_excl_tp]
+        df_raw_tp_pgns = df_raw_tp["ID"].apply(self.calculate_pgn) if self.tp_type == "nmea" else None
+
+        for res_id in res_id_list:
+            df_raw_tp_res_id = self.filter_df_raw_tp(df_raw_tp, df_raw_tp_pgns, res_id)
+
+            for channel, df_channel in df_raw_tp_res_id.groupby("BusChannel"):
+                for identifier, df_raw_filter in df_channel.groupby(frame_struct["group"]):
+                    base_frame = df_raw_filter.iloc[0]
+                    frame_list = []
+                    frame_timestamp_list = []
+                    payload_concatenated = []
+                    ff_length = 0xFFF
+                    can_id = None
+                    conseq_frame_prev = None
+
+                    for row in df_raw_filter.itertuples(index=True, name="Pandas"):
+                        index = row.Index
+                        first_frame_test = self.check_if_first_frame(row, bam_pgn, frame_struct["FIRST_FRAME_MASK"], frame_struct["FIRST_FRAME"])
+                        first_byte = row.DataBytes[0]
+
+                        if self.tp_type != "nmea" and (first_byte & frame_struct["SINGLE_FRAME_MASK"] == frame_struct["SINGLE_FRAME"]):
+                            frame_list.append(self.construct_new_tp_frame(base_frame, row.DataBytes, row.ID).values.tolist())
+                            frame_timestamp_list.append(index)
+
+                        elif first_frame_test:
+                            if len(payload_concatenated) >= ff_length:
+                                frame_list.append(self.construct_new_tp_frame(base_frame, payload_concatenated, can_id).values.tolist())
+                                frame_timestamp_list.append(frame_timestamp)
+
+                            conseq_frame_prev = None
+                            frame_timestamp = index
+                            if self.tp_type == "j1939":
+                                can_id = self.pgn_to_can_id(row)
+                            ff_length = self.get_payload_length(row)
+                            payload_concatenated = row.DataBytes[ff_payload_start:]
+
+                        elif (conseq_frame_prev == None) or ((first_byte - conseq_frame_prev) == 1):
+                            conseq_frame_prev = first_byte
+                            payload_concatenated += row.DataBytes[1:]
+
+                    df_raw.append(pd.DataFrame(frame_list, columns=base_frame.index, index=frame_timestamp_list))
+
+        df_raw = pd.concat([df for df in df_raw if not df.empty], join="outer")
+        df_raw.index.name = "TimeStamp"
+        return df_raw.sort_index()
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def tp_rows(tp_type: str, rng: random.Random, num_of_sequences: int) -> list:
+    """Returns (bus channel, CAN ID, data bytes) of random TP sequences with reordered, repeated, missing and broken frames"""
+    rows = []
+    for _ in range(num_of_sequences):
+        channel = rng.choice([1, 2])
+
+        if tp_type == "j1939":
+            sa = rng.choice([0x00, 0x03, 0x17])
+            pgn = rng.choice([0xFECA, 0xFEE5, 0x00F004])
+            num_of_bytes = rng.randint(9, 40)
+            packets = (num_of_bytes + 6) // 7
+            announcement = [0x20, num_of_bytes & 0xFF, num_of_bytes >> 8, packets, 0xFF, pgn & 0xFF, (pgn >> 8) & 0xFF, pgn >> 16]
+            if rng.random() < 0.05:
+                announcement[0] = 0xFF
+            rows.append((channel, 0x18ECFF00 | sa, announcement))
+
+            sequence = list(range(1, packets + 1))
+            if rng.random() < 0.2:
+                rng.shuffle(sequence)
+            if rng.random() < 0.1:
+                sequence = sequence[:-1]
+            if rng.random() < 0.1:
+                sequence.insert(1, sequence[0])
+            for number in sequence:
+                data = [number] + [rng.randint(0, 255) for _ in range(7)]
+                if rng.random() < 0.03:
+                    data[0] = 0x20
+                if rng.random() < 0.02:
+                    data[0] = 0xFF
+                rows.append((channel, 0x18EBFF00 | sa, data))
+            if rng.random() < 0.3:
+                rows.append((channel, 0x0CF00400 | sa, [rng.randint(0, 255) for _ in range(8)]))
+
+        elif tp_type == "uds":
+            can_id = rng.choice([1960, 2016, 2025])
+            if rng.random() < 0.3:
+                rows.append((channel, can_id, [3, 0x62, 1, 2, 0xAA, 0xAA, 0xAA, 0xAA]))
+                continue
+            length = rng.randint(8, 60)
+            rows.append((channel, can_id, [0x10 | (length >> 8), length & 0xFF] + [rng.randint(0, 255) for _ in range(6)]))
+            for number in range(1, length // 7 + 1):
+                if rng.random() < 0.05:
+                    continue
+                rows.append((channel, can_id, [0x20 | (number & 0xF)] + [rng.randint(0, 255) for _ in range(rng.choice([7, 7, 7, 3]))]))
+            if rng.random() < 0.2:
+                rows.append((channel, can_id, [0x30, 0, 0]))
+
+        else:
+            can_id = rng.choice([0x09F80101, 0x09F80202, 0x1DEFFF03])
+            length = rng.randint(7, 40)
+            counter = rng.randint(0, 7) << 5
+            rows.append((channel, can_id, [counter, length] + [rng.randint(0, 255) for _ in range(6)]))
+            for number in range(1, length // 7 + 1):
+                if rng.random() < 0.05:
+                    continue
+                rows.append((channel, can_id, [counter | number] + [rng.randint(0, 255) for _ in range(7)]))
+
+    # frames which are not TP
+    rows += [(1, 0x0CF00400, [1, 2, 3, 4, 5, 6, 7, 8])] * 3
+    return rows
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+def raw_frames(rows: list, seed: int) -> pd.DataFrame:
+    """Returns a raw dataframe as read by mdf_iter with sorted time stamps, some of them repeated"""
+    time_stamps = np.sort(np.random.default_rng(seed).integers(0, 10**9, len(rows))) + 1_700_000_000_000_000_000
+    time_stamps[5::13] = time_stamps[4::13][:len(time_stamps[5::13])]
+    index = pd.DatetimeIndex(pd.to_datetime(time_stamps, utc=True), name="TimeStamp")
+
+    return pd.DataFrame({"BusChannel": np.array([row[0] for row in rows], dtype=np.uint8),
+                         "ID": np.array([row[1] for row in rows], dtype=np.uint32),
+                         "IDE": np.ones(len(rows), dtype=np.uint8),
+                         "DLC": np.array([len(row[2]) for row in rows], dtype=np.uint8),
+                         "DataLength": np.array([len(row[2]) for row in rows], dtype=np.uint8),
+                         "Dir": np.zeros(len(rows), dtype=bool),
+                         "DataBytes": [list(row[2]) for row in rows]}, index=index)
+
+# ================================================================================================================================
+# ================================================================================================================================
+
+
+@pytest.mark.parametrize("tp_type", ["j1939", "uds", "nmea"])
+@pytest.mark.parametrize("seed", range(30))
+def test_matches_baseline(tp_type, seed):
+    rng = random.Random(seed)
+    df_raw = raw_frames(tp_rows(tp_type, rng, rng.randint(0, 30)), seed)
+
+    expected = BaselineDecoder(tp_type).combine_tp_frames(df_raw.copy())
+    result = MultiFrameDecoder(tp_type).combine_tp_frames(df_raw.copy())
+
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    assert (result.dtypes.drop("ID") == expected.dtypes.drop("ID")).all()
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize("tp_type", ["j1939", "uds", "nmea"])
+def test_without_tp_frames(tp_type):
+    df_raw = raw_frames([(1, 0x0CF00400, [1, 2, 3, 4, 5, 6, 7, 8])] * 4, 0)
+    pd.testing.assert_frame_equal(MultiFrameDecoder(tp_type).combine_tp_frames(df_raw.copy()), df_raw)
+
+# --------------------------------------------------------------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_open_segments_continue(seed):
+    rng = random.Random(seed)
+    df_raw = raw_frames(tp_rows("j1939", rng, 30), seed)
+    tp = MultiFrameDecoder("j1939")
+    expected = tp.combine_tp_frames(df_raw.copy())
+
+    # split into two chunks, the open segments of the first one are prepended to the second one
+    split = rng.randint(1, df_raw.shape[0] - 1)
+    ready, open_segments = tp.split_open_segments(df_raw.iloc[:split])
+    result = pd.concat([tp.combine_tp_frames(ready), tp.combine_tp_frames(pd.concat([open_segments, df_raw.iloc[split:]]))])
+
+    pd.testing.assert_frame_equal(result.sort_index(kind="stable"), expected, check_dtype=False)